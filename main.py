@@ -5,11 +5,12 @@ import os
 import signal
 import sys
 import time
-import thread
 import threading
 from Queue import Queue
 import datetime
-from resources.lib.utils import RESOURCES_FOLDER, DEVNULL, PlayerMetaData, StatesDict, ConfigDict, HOSTNAME, APPNAME, json, check_software, run_proc, IS_DIETPI, PLAYING_STATES, VOLUME_CONTROL_SOFT, VOLUME_CONTROL_DISABLED, PLAYING_STATE, INTERRUPT_STATES, IDLE_STATES, PAUSED_STATE, IDLE_STATE, ALERT_STATE
+from resources.lib.scheduler import PollScheduler
+from resources.lib.coverart import CoverArtCache
+from resources.lib.utils import RESOURCES_FOLDER, DEVNULL, PlayerMetaData, StatesDict, SerialWorkerPool, ConfigDict, HOSTNAME, APPNAME, json, check_software, run_proc, IS_DIETPI, PLAYING_STATES, VOLUME_CONTROL_SOFT, VOLUME_CONTROL_DISABLED, PLAYING_STATE, INTERRUPT_STATES, IDLE_STATES, PAUSED_STATE, IDLE_STATE, ALERT_STATE, VOLUME_STEP
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,12 +27,17 @@ LOGGER.addHandler(consolehandler)
 LOGGER.setLevel(logging.INFO)
 
 CONFIG_FILE = '/etc/pi-monitor.json'
+STATE_LISTENER_WORKERS = 2
+VOLUME_UP_COMMANDS = ["volup", "volumeup", "volume_up"]
+VOLUME_DOWN_COMMANDS = ["voldown", "volumedown", "volume_down"]
 
 
 class Monitor():
     states = StatesDict()
     config = ConfigDict()
-    _cmd_queue = Queue()
+    scheduler = None
+    cover_cache = None
+    _cmd_executor = None
     _event = threading.Event()
     _loaded_modules = []
     _exit = False
@@ -47,17 +53,21 @@ class Monitor():
     def player_info(self):
         return self.states["player"]
 
+    @property
+    def dispatch_latency(self):
+        ''' latency stats of the state listener dispatch (not a state itself: updating it would dispatch another event)'''
+        return self._state_watcher.latency_stats
+
     def command(self, target, cmd, data=None, blocking=False):
         '''put command in the queue'''
-        if blocking:
+        if blocking or not self._cmd_executor:
             self._process_command(target, cmd, data)
         else:
-            self._cmd_queue.put((target, cmd, data))
-            self._event.set()
+            self._cmd_executor.submit(target, target, cmd, data)
 
-    def register_state_callback(self, callback, filter=None):
+    def register_state_callback(self, callback, filter=None, subkey_filter=None):
         '''allow modules to listen for state changed events'''
-        self._state_watcher.register_state_callback(callback, filter)
+        self._state_watcher.register_state_callback(callback, filter, subkey_filter)
 
     def deregister_state_callback(self, callback, keyfilter=None):
         self._state_watcher.deregister_state_callback(callback, keyfilter)
@@ -96,6 +106,18 @@ class Monitor():
             LOGGER.debug("using config: %s" % self.config)
         if self.config["AUTO_UPDATE_ON_STARTUP"]:
             check_software("17", "/usr/bin/git", "git")
+        # cover art of all players, by checksum
+        self.cover_cache = CoverArtCache(self.config["COVER_CACHE_SIZE"] * 1024 * 1024, 
+                self.config["COVER_CACHE_DIR"] or None)
+        self.cover_cache.start()
+        # start the command executor: commands are processed in order per target by a fixed pool of workers
+        self.states["commands"] = {"queued": 0, "running": 0, "dropped": 0}
+        self._cmd_executor = SerialWorkerPool(self._process_command, 
+                num_workers=self.config["COMMAND_WORKERS"], 
+                max_queue=self.config["COMMAND_QUEUE_LIMIT"], 
+                stats=self.states["commands"], name="command", 
+                coalesce=self._coalesce_command)
+        self._cmd_executor.start()
         self.states["player"] = PlayerMetaData("")
         self.states["player"].update({
                 "power": False, 
@@ -109,6 +131,10 @@ class Monitor():
         for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
             signal.signal(sig, self._cleanup)
 
+        # all periodic polling of the modules is done from one timer thread
+        self.scheduler = PollScheduler()
+        self.scheduler.start()
+
         # setup (optional) modules
         self._setup_modules()
         # set default/startup volume if needed
@@ -118,22 +144,64 @@ class Monitor():
         self.command("system","ping")
         loop_timeout = 1200
         while not self._exit:
-            # process commands queue
-            while not self._cmd_queue.empty() and not self._exit:
-                data = self._cmd_queue.get()
-                # fire each command in it's own seperate thread
-                #data = *data
-                thread.start_new_thread(self._process_command, (data))
-            # wait for events in the queue
-            if self._exit:
-                break
+            # commands are handled by the executor, just keep the main thread alive
             self._event.wait(loop_timeout)
             self._event.clear()
 
+    def _coalesce_command(self, pending, new_cmd):
+        ''' merge a relative volume command with a pending volume step for the same target'''
+        target, cmd, cmd_data = new_cmd
+        step = self._get_volume_step(cmd, cmd_data)
+        last_step = self._get_volume_step(*pending[-1][1:])
+        if not step or not last_step:
+            return False
+        pending[-1] = (target, "volume_step", last_step + step)
+        LOGGER.debug("merged volume command %s for target %s into pending volume step %s" %(cmd, target, last_step + step))
+        return True
+
+    @staticmethod
+    def _get_volume_step(cmd, cmd_data=None):
+        ''' returns the relative volume change for a volume command, 0 for any other command'''
+        if cmd in VOLUME_UP_COMMANDS:
+            return VOLUME_STEP
+        elif cmd in VOLUME_DOWN_COMMANDS:
+            return -VOLUME_STEP
+        elif cmd == "volume_step":
+            return int(cmd_data)
+        return 0
+
+    def _get_volume_level(self, target):
+        '''
+            get the live volume level of the backend that handles the volume commands for the given target,
+            None if it can't report one: only the modules with a volume property (alsa, squeezelite, roon) take volume_set
+        '''
+        if target == "player":
+            # same routing as _player_command: alsa unless a player is playing
+            cur_player = self.states["player"]["current_player"]
+            if cur_player and self.states["player"]["state"] == PLAYING_STATE:
+                target = cur_player
+            else:
+                target = "alsa"
+        return getattr(self.get_module(target), "volume", None)
+
+    def _resolve_volume_step(self, target, step):
+        ''' the command(s) for a (merged) relative volume change, resolved at dispatch time'''
+        volume_level = self._get_volume_level(target)
+        if volume_level is not None:
+            # one absolute level, based on the same backend that applies it
+            return [("volume_set", max(0, min(100, int(volume_level) + step)))]
+        # e.g. spotify and airplay: their volume is on their own scale, keep it relative
+        cmd = "volume_up" if step > 0 else "volume_down"
+        return [(cmd, None)] * int(round(abs(step) / float(VOLUME_STEP)))
+
     def _process_command(self, target, cmd, cmd_data=None):
         ''' process command from the queue '''
         try:
             LOGGER.debug("processing command %s for target %s with data %s" %(cmd, target, str(cmd_data)))
+            if cmd == "volume_step":
+                for cmd, cmd_data in self._resolve_volume_step(target, int(cmd_data)):
+                    self._process_command(target, cmd, cmd_data)
+                return
             if target == "player":
                 # redirect player commands
                 self._player_command(cmd, cmd_data)
@@ -149,6 +217,9 @@ class Monitor():
                 # system commands
                 if cmd == "saveconfig":
                     self._saveconfig()
+                elif cmd == "persistconfig":
+                    # config changed by the modules themselves (e.g. a discovered server), no need to tell the user
+                    self._write_config()
                 elif cmd == "run_proc" and cmd_data:
                     run_proc(cmd_data)
                 elif cmd in ["restart", "reboot"]:
@@ -177,9 +248,9 @@ class Monitor():
             cmd = "next"
         elif cmd in ["toggle", "toggleplaypause", "toggleplay", "togglepause", "playpause"]:
             cmd = "pause" if self.is_playing else "play"
-        elif cmd in ["volup", "volumeup", "volume_up"]:
+        elif cmd in VOLUME_UP_COMMANDS:
             cmd = "volume_up"
-        elif cmd in ["voldown", "volumedown", "volume_down"]:
+        elif cmd in VOLUME_DOWN_COMMANDS:
             cmd = "volume_down"
         elif cmd in ["volume", "setvolume", "volume_set", "set_volume"]:
             cmd = "volume_set"
@@ -306,10 +377,14 @@ class Monitor():
         self._set_power(False)
 
         self._event.set()
+        self._cmd_executor.stop()
         self._state_watcher.stop()
 
         # stop all loaded optional modules
         self._unload_modules()
+        if self.scheduler:
+            self.scheduler.stop()
+        self.cover_cache.stop()
         
         # Exit from our application
         LOGGER.info("Exiting on signal %d" % (signum))
@@ -317,15 +392,21 @@ class Monitor():
 
     def _saveconfig(self, autoreload=True, force=False):
         config_changed = self._lastconfig != self.config["last_updated"]
-        with open(CONFIG_FILE, "w") as json_file:
-            json_file.write(self.config.json)
+        self._write_config()
         if config_changed:
-            self._lastconfig = self.config
+            self._lastconfig = self.config["last_updated"]
             LOGGER.info("The configuration is changed!")
             self.states["messages"].append("Configuration change detected. It might be required to reload or restart.")
         else:
             LOGGER.info("Configuration did not change!")
 
+    def _write_config(self):
+        ''' write the config to disk'''
+        # write to a temp file first, a power cut while writing must not leave us without config
+        with open(CONFIG_FILE + ".tmp", "w") as json_file:
+            json_file.write(self.config.json)
+        os.rename(CONFIG_FILE + ".tmp", CONFIG_FILE)
+
     def _parseconfig(self):
         ''' get config from player's json configfile'''
         try:
@@ -342,6 +423,10 @@ class Monitor():
             ("VOLUME_LIMITER", config.get("VOLUME_LIMITER",0)),
             ("VOLUME_LIMITER_MORNING", config.get("VOLUME_LIMITER_MORNING",0)),            
             ("ENABLE_DEBUG", config.get("ENABLE_DEBUG", False)),
+            ("COMMAND_WORKERS", config.get("COMMAND_WORKERS", 3)),
+            ("COMMAND_QUEUE_LIMIT", config.get("COMMAND_QUEUE_LIMIT", 50)),
+            ("COVER_CACHE_SIZE", config.get("COVER_CACHE_SIZE", 8)),
+            ("COVER_CACHE_DIR", config.get("COVER_CACHE_DIR", "")),
             ("AUTO_UPDATE_ON_STARTUP", config.get("AUTO_UPDATE_ON_STARTUP", True))
         ])
         # append other config keys which are set by modules
@@ -359,7 +444,8 @@ class StatesWatcher(threading.Thread):
     _event = threading.Event()
     _callback = None
     _event_queue = Queue()
-    _state_listeners = []
+    _state_listeners = {} # key filter --> list of (callback, subkey filter)
+    _listeners_lock = threading.Lock()
 
     def __init__(self, monitor):
         self.monitor = monitor
@@ -367,14 +453,19 @@ class StatesWatcher(threading.Thread):
         threading.Thread.__init__(self)
         self.monitor.states.state_listener = self._state_callback
         self.monitor.config.state_listener = self._state_callback
+        # listeners are called from a small pool of workers, events for the same listener are delivered in order
+        self._listener_pool = SerialWorkerPool(self._call_listener, num_workers=STATE_LISTENER_WORKERS, name="statelistener")
+        self._latency_lock = threading.Lock()
+        self.dispatch_latency = {"count": 0, "avg": 0.0, "max": 0.0}
 
     def run(self):
+        self._listener_pool.start()
         while not self._exit:
             try:
                 # process queue
                 while not self._event_queue.empty():
                     data = self._event_queue.get()
-                    self._handle_state_event(data)
+                    self._handle_state_event(*data)
             except Exception:
                 LOGGER.exception("Error while processing StatesQueue - %s" % str(data))
             # wait for events in the queue
@@ -384,95 +475,136 @@ class StatesWatcher(threading.Thread):
     def stop(self):
         self._exit = True
         self._event.set()
+        self._listener_pool.stop()
         self.join(1)
 
-    def register_state_callback(self, callback, filter=None):
+    def register_state_callback(self, callback, filter=None, subkey_filter=None):
         '''allow modules to listen for state changed events'''
-        self._state_listeners.append((callback, filter))
+        with self._listeners_lock:
+            listeners = self._state_listeners.get(filter, [])
+            self._state_listeners[filter] = listeners + [(callback, subkey_filter)]
 
     def deregister_state_callback(self, callback, keyfilter=None):
-        item = (callback, keyfilter)
-        try:
-            self._state_listeners.remove(item)
-        except Exception:
-            LOGGER.exception("error while deregistering callback")
+        with self._listeners_lock:
+            listeners = self._state_listeners.get(keyfilter, [])
+            remaining = [item for item in listeners if item[0] != callback]
+            if len(remaining) == len(listeners):
+                LOGGER.warning("error while deregistering callback: callback is not registered")
+            self._state_listeners[keyfilter] = remaining
 
     def _state_callback(self, event_data):
         '''put state update in the queue'''
-        self._event_queue.put(event_data)
+        self._event_queue.put((event_data, time.time()))
         self._event.set()
 
-    def _handle_state_event(self, event_data):
+    def _handle_state_event(self, event_data, event_time):
         '''handle a state changed event on the command bus'''
         LOGGER.debug("state changed! %s - " % str(event_data))
         key = event_data[0]
-        subkey = event_data[2]
-        for state_listener in self._state_listeners:
-            key_filter = state_listener[1]
-            if not key_filter or key_filter == key:
-                # pass event to attached listeners in seperate threads to make sure nothing is blocking
-                try:
-                    thread.start_new_thread(state_listener[0], (event_data))
-                except Exception:
-                    LOGGER.exception("failed to handle state event")
+        changes = event_data[3]
+        # only the listeners for this key and the listeners without filter are interested
+        for key_filter in (key, None):
+            for callback, subkey_filter in self._state_listeners.get(key_filter, ()):
+                if not subkey_filter or subkey_filter in changes:
+                    self._listener_pool.submit(callback, callback, event_data, event_time)
         if "player" in self.states and "players" in self.states["player"]: # check is needed because of initialization order
             if key in self.states["player"]["players"]:
                 # we received an update from one of the players
+                if "cover_url" in changes:
+                    self._prefetch_cover(key)
                 self._handle_player_state_change(key)
-        if "volume_level" in [key, subkey]:
+        if key == "volume_level" or "volume_level" in changes:
             self._handle_volume_limiter()
 
+    @property
+    def latency_stats(self):
+        with self._latency_lock:
+            return dict(self.dispatch_latency)
+
+    def _call_listener(self, callback, event_data, event_time):
+        '''pass event to an attached listener (called from the listener pool)'''
+        latency = time.time() - event_time
+        with self._latency_lock:
+            stats = self.dispatch_latency
+            stats["avg"] = (stats["avg"] * stats["count"] + latency) / (stats["count"] + 1)
+            stats["count"] += 1
+            if latency > stats["max"]:
+                stats["max"] = latency
+                LOGGER.debug("new max state dispatch latency: %.3f seconds" % latency)
+        callback(*event_data)
+
+    def _prefetch_cover(self, player_key):
+        ''' download the cover art of a player in the background, the cover id is set when it's in the cache'''
+        player_states = self.states[player_key]
+        cover_url = player_states["cover_url"]
+
+        def cover_fetched(cover_id):
+            # ignore the result if the player moved on to another cover in the mean time
+            if cover_id and player_states["cover_url"] == cover_url:
+                player_states["cover_id"] = cover_id
+
+        cover_id = self.monitor.cover_cache.fetch_url(cover_url, cover_fetched)
+        if player_states["cover_id"] != cover_id:
+            player_states["cover_id"] = cover_id
+
     def _handle_player_state_change(self, player_key):
         ''' handle state changed event for the mediaplayers'''
-        cur_player = self.states["player"]["current_player"]
-        cur_player_state = self.states[cur_player]["state"] if cur_player else IDLE_STATE
-        new_player = player_key
-        new_player_state = self.states[player_key]["state"]
-        update_info = {}
-
-        # if we don't have a current player and a (new) player starts playing or if we have an idle current player and the new player is not idle (e.g. paused etc.)
-        if ((cur_player != new_player and new_player_state in PLAYING_STATES) or 
-                (cur_player_state == IDLE_STATE and new_player_state != IDLE_STATE)):
-            # we have a new active player!
-            self.states["player"]["current_player"] = new_player
-            LOGGER.info("active player changed to %s" % new_player)
+        # the module commands (network requests) are only run after the transaction,
+        # the lock on the player state must not be held while we wait for them
+        actions = []
+        with self.states["player"].transaction():
+            # all changes to the player state are broadcasted as one event
+            cur_player = self.states["player"]["current_player"]
+            cur_player_state = self.states[cur_player]["state"] if cur_player else IDLE_STATE
+            new_player = player_key
+            new_player_state = self.states[player_key]["state"]
+            update_info = {}
+
+            # if we don't have a current player and a (new) player starts playing or if we have an idle current player and the new player is not idle (e.g. paused etc.)
+            if ((cur_player != new_player and new_player_state in PLAYING_STATES) or 
+                    (cur_player_state == IDLE_STATE and new_player_state != IDLE_STATE)):
+                # we have a new active player!
+                self.states["player"]["current_player"] = new_player
+                LOGGER.info("active player changed to %s" % new_player)
             
-            # signal current player about this so it must stop playing
-            if new_player_state in PLAYING_STATES and cur_player_state in PLAYING_STATES:
-                self.monitor.get_module(cur_player).command("stop")
-                # todo: handle flush of audio device if needed ?
+                # signal current player about this so it must stop playing
+                if new_player_state in PLAYING_STATES and cur_player_state in PLAYING_STATES:
+                    actions.append((self.monitor.get_module(cur_player).command, "stop"))
+                    # todo: handle flush of audio device if needed ?
             
-            # handle notifications and alerts
-            if new_player_state in INTERRUPT_STATES:
-                # a notification or alert started, store previous player and set notification volume level
-                self.states["player"]["interrupted_player"] = cur_player
-                self.states["player"]["interrupted_volume"] = self.monitor.get_module("alsa").volume
-                self.states["player"]["interrupted_state"] = cur_player_state
-                if new_player_state == ALERT_STATE and self.monitor.config["ALERT_VOLUME"]:
-                    self.monitor.get_module("alsa").command("volume_set", self.monitor.config["ALERT_VOLUME"])
-                elif self.monitor.config["NOTIFY_VOLUME"]:
-                    self.monitor.get_module("alsa").command("volume_set", self.monitor.config["NOTIFY_VOLUME"])
+                # handle notifications and alerts
+                if new_player_state in INTERRUPT_STATES:
+                    # a notification or alert started, store previous player and set notification volume level
+                    self.states["player"]["interrupted_player"] = cur_player
+                    self.states["player"]["interrupted_volume"] = self.monitor.get_module("alsa").volume
+                    self.states["player"]["interrupted_state"] = cur_player_state
+                    if new_player_state == ALERT_STATE and self.monitor.config["ALERT_VOLUME"]:
+                        actions.append((self.monitor.get_module("alsa").command, "volume_set", self.monitor.config["ALERT_VOLUME"]))
+                    elif self.monitor.config["NOTIFY_VOLUME"]:
+                        actions.append((self.monitor.get_module("alsa").command, "volume_set", self.monitor.config["NOTIFY_VOLUME"]))
         
-        # the notification/alert stopped, restore the previous state
-        elif (self.states["player"]["interrupted_player"] and 
-                    player_key == cur_player and new_player_state in IDLE_STATES):
-            self.monitor.get_module("alsa").command("volume_set", self.states["player"]["interrupted_volume"])
-            if self.states["player"]["interrupted_state"] == PLAYING_STATE:
-                self.monitor.command(self.states["player"]["interrupted_player"], "play")
-            LOGGER.info("active player restored to %s" % self.states["player"]["interrupted_player"])
-            self.states["player"]["current_player"] = self.states["player"]["interrupted_player"]
-            self.states["player"]["interrupted_volume"] = 0
-            self.states["player"]["interrupted_player"] = ""
-            self.states["player"]["interrupted_state"] = ""
+            # the notification/alert stopped, restore the previous state
+            elif (self.states["player"]["interrupted_player"] and 
+                        player_key == cur_player and new_player_state in IDLE_STATES):
+                actions.append((self.monitor.get_module("alsa").command, "volume_set", self.states["player"]["interrupted_volume"]))
+                if self.states["player"]["interrupted_state"] == PLAYING_STATE:
+                    self.monitor.command(self.states["player"]["interrupted_player"], "play")
+                LOGGER.info("active player restored to %s" % self.states["player"]["interrupted_player"])
+                self.states["player"]["current_player"] = self.states["player"]["interrupted_player"]
+                self.states["player"]["interrupted_volume"] = 0
+                self.states["player"]["interrupted_player"] = ""
+                self.states["player"]["interrupted_state"] = ""
         
-        # metadadata update of current player
-        cur_player = self.states["player"]["current_player"]
-        if cur_player:
-            self.states["player"].update(self.states[cur_player])
+            # metadadata update of current player
+            cur_player = self.states["player"]["current_player"]
+            if cur_player:
+                self.states["player"].update(self.states[cur_player])
         
-        # turn player on if needed
-        if not self.states["player"]["power"] and self.states["player"]["state"] in PLAYING_STATES:
-            self.monitor.command("power", "poweron")
+            # turn player on if needed
+            if not self.states["player"]["power"] and self.states["player"]["state"] in PLAYING_STATES:
+                self.monitor.command("power", "poweron")
+        for action in actions:
+            action[0](*action[1:])
     
     def _handle_volume_limiter(self):
         ''' check if volume_level is higher than the allowed setting '''
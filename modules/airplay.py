@@ -10,6 +10,8 @@ import subprocess
 from resources.lib.utils import PlayerMetaData, json, DEVNULL, requests, import_or_install, global_import, check_software, run_proc, HOSTNAME, VOLUME_CONTROL_DISABLED
 
 LOOP_WAIT = 2
+RTP_RATE = 44100.0 # rtp timestamps per second in the progress info
+FIFO_READ_SIZE = 65536
 
 EXEC_BIN = "/usr/local/bin/shairport-sync"
 EXEC_CONF = "/tmp/shairport-sync.conf"
@@ -25,10 +27,9 @@ def setup(monitor):
         LOGGER.warning("shairport-sync is not installed, please install manually.")
         return False
 
-    import_or_install("DictObject")
     import_or_install("magic", installpip="python-magic")
     global_import("resources.lib.shairportdecoder.remote", "AirplayRemote", True)
-    global_import("resources.lib.shairportdecoder.decoder", ["Processor", "VOLUME", "COVERART", "META", "CLIENT_REMOTE_AVAILABLE"], True)
+    global_import("resources.lib.shairportdecoder.decoder", ["Processor", "VOLUME", "COVERART", "META", "CLIENT_REMOTE_AVAILABLE", "PROGRESS", "STATE"], True)
     global_import("resources.lib.shairportdecoder.metadata", "Infos", True)
 
     return AirPlayPlayer(monitor)
@@ -78,11 +79,11 @@ class AirPlayPlayer(threading.Thread):
 
     def _event_processor(self, event_type, info):
         assert(isinstance(info, Infos))
-        self._update_metadata()
+        self._update_metadata(event_type)
         if event_type == VOLUME:
             LOGGER.debug("Changed Volume to {vol}.".format(vol = info.volume))
         elif event_type == COVERART:
-            LOGGER.debug("Retrieved CoverArt - saved to %s" % self._processor.info.cover_file)
+            LOGGER.debug("Retrieved CoverArt - %s" % self._processor.info.songcoverart.checksum)
         elif event_type == META:
             LOGGER.debug("Got Metadata: %s" % info.to_simple_string().encode("utf-8")) # lol, meat typo.
         elif event_type == CLIENT_REMOTE_AVAILABLE:
@@ -91,22 +92,27 @@ class AirPlayPlayer(threading.Thread):
         else:
             LOGGER.debug("event_type: %s" % event_type)
 
-    def _update_metadata(self):
-        self.monitor.states["airplay"].update({
-                "state": self._processor.info.playstate,
+    def _update_metadata(self, event_type=None):
+        metadata = {
                 "volume_level": self._processor.info.volume * 100 if self._processor.info.volume else 0,
                 "artist": self._processor.info.songartist,
                 "album": self._processor.info.songalbum,
                 "title": self._processor.info.itemname,
                 "duration": self._processor.info.songtime/1000 if self._processor.info.songtime else 0
-            })
-        if self._processor.info.cover_file:
-            self.monitor.states["airplay"]["cover_file"] = self._processor.info.cover_file
-        elif self._processor.info.songcoverart.base64:
-            self.monitor.states["airplay"]["cover_art"] = self._processor.info.songcoverart.base64
-        else:
-            self.monitor.states["airplay"]["cover_file"] = ""
-            self.monitor.states["airplay"]["cover_art"] = ""
+            }
+        cover_art = self._processor.info.songcoverart
+        if event_type == COVERART and cover_art.binary:
+            # the same cover is stored only once, by checksum
+            metadata["cover_id"] = self.monitor.cover_cache.put(cover_art.binary, cover_art.checksum)
+        player_states = self.monitor.states["airplay"]
+        with player_states.transaction():
+            player_states.update(metadata)
+            # the position is only known from the progress info, it is extrapolated in between
+            player_states.set_state(self._processor.info.playstate)
+            if event_type == PROGRESS and self._processor.info.progress:
+                start, current, end = self._processor.info.progress
+                # rtp timestamps are 32 bits and may wrap around
+                player_states.set_position(((current - start) % 2**32) / RTP_RATE)
 
     def _create_config(self):
         # create shairport sync config
@@ -150,17 +156,14 @@ class AirPlayPlayer(threading.Thread):
         self._processor = Processor()
         self._processor.add_listener(self._event_processor)
         LOGGER.info("Start Parsing named pipe: %s" % EXEC_FIFO)
-        self._fifo_buffer = open(EXEC_FIFO)
-        temp_line = ""
+        self._fifo_buffer = os.open(EXEC_FIFO, os.O_RDONLY)
         while not self._exit.isSet():
-            line = self._fifo_buffer.readline()
-            if not line:
+            # the processor cuts the items from the raw data itself, no need to split it in lines here
+            data = os.read(self._fifo_buffer, FIFO_READ_SIZE)
+            if not data:
+                # no writer on the other end of the pipe (yet)
                 self._exit.wait(0.1)
-            if not line.strip().endswith("</item>"):
-                temp_line += line.strip()
                 continue
-            line = temp_line + line
-            temp_line = ""
             if not self._exit.isSet():
-                self._processor.process_line(line)
-        
\ No newline at end of file
+                self._processor.process_data(data)
+        os.close(self._fifo_buffer)
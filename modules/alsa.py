@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import os
+import math
+import select
 import subprocess
-from resources.lib.utils import import_or_install, VOLUME_CONTROL_DISABLED, VOLUME_CONTROL_SOFT
+import threading
+from resources.lib.utils import import_or_install, VOLUME_CONTROL_DISABLED, VOLUME_CONTROL_SOFT, VOLUME_STEP, PLAYING_STATE
 
 
 def setup(monitor):
@@ -11,29 +14,104 @@ def setup(monitor):
     return AlsaVolume(monitor)
 
 
-class AlsaVolume(object):
+# see volume_mapping.c in alsa-utils, used by amixer -M
+MAX_LINEAR_DB_SCALE = 24
+SND_CTL_TLV_DB_GAIN_MUTE = -9999999
+
+
+class AlsaVolume(threading.Thread):
     _exit = False
+    _mixer = None
+    _mixer_failed = False
+    _volume_cache = None
+    _volume_cache_gen = 0
+    cache_hits = 0
+    cache_misses = 0
 
     def __init__(self, monitor):
         self.monitor = monitor
         self.monitor.states["alsa"] = {
                 "audio_devices": [],
                 "capture_devices": [],
-                "mixers": []
+                "mixers": [],
+                "volume_level": 0,
+                "muted": False
             }
+        self._wakeup_fds = os.pipe()
+        threading.Thread.__init__(self)
         self._setup_alsa_config()
-        self.monitor.states["player"]["volume_level"] = self._volume_get()
-        LOGGER.info("current alsa volume level: %s" % self._volume_get())
+        volume_level = self.volume
+        self.monitor.states["player"]["volume_level"] = volume_level
+        LOGGER.info("current alsa volume level: %s" % volume_level)
 
     @property
     def volume(self):
-        return self._volume_get()
+        ''' current volume level, served from cache as long as we receive change events from the mixer'''
+        volume = self._volume_cache
+        if volume is not None:
+            self.cache_hits += 1
+            return volume
+        self.cache_misses += 1
+        cache_gen = self._volume_cache_gen
+        volume = self._volume_get()
+        if self._mixer and self.is_alive() and cache_gen == self._volume_cache_gen:
+            # only cache if the value was not invalidated while we were reading it
+            self._volume_cache = volume
+        return volume
+
+    @property
+    def volume_cache_stats(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses}
     
     def stop(self):
+        LOGGER.debug("alsa volume cache stats: %s" % self.volume_cache_stats)
         self._exit = True
+        self._wakeup()
+        threading.Thread.join(self, 2)
 
-    def start(self):
-        pass
+    def run(self):
+        ''' watch the mixer's poll descriptors for volume/mute changes, also those made by other processes'''
+        while not self._exit:
+            mixer = self._get_mixer()
+            poller = select.poll()
+            poller.register(self._wakeup_fds[0], select.POLLIN)
+            if mixer:
+                for fd, eventmask in mixer.polldescriptors():
+                    poller.register(fd, eventmask)
+            # block until the mixer reports an event or we get woken up (e.g. mixer opened or exit)
+            for fd, event in poller.poll():
+                if fd == self._wakeup_fds[0]:
+                    os.read(fd, 512)
+            if mixer and not self._exit:
+                try:
+                    mixer.handle_events()
+                    self._invalidate_volume_cache()
+                    self._update_volume_state()
+                except Exception:
+                    LOGGER.exception("error while handling alsa mixer events")
+                    self._exit_wait(1)
+
+    def _update_volume_state(self):
+        ''' push the current volume and mute state of the mixer to the states'''
+        volume_level = self.volume
+        self.monitor.states["alsa"].update({"volume_level": volume_level, "muted": self._mixer.get_mute()})
+        # alsa is only the player's volume control if no player is playing (see Monitor._player_command),
+        # a playing player reports the volume on its own scale
+        if self.monitor.states["player"]["state"] != PLAYING_STATE:
+            self.monitor.states["player"]["volume_level"] = volume_level
+
+    def _invalidate_volume_cache(self):
+        self._volume_cache_gen += 1
+        self._volume_cache = None
+
+    def _wakeup(self):
+        os.write(self._wakeup_fds[1], "1")
+
+    def _exit_wait(self, timeout):
+        ''' sleep unless we need to exit'''
+        poller = select.poll()
+        poller.register(self._wakeup_fds[0], select.POLLIN)
+        poller.poll(timeout * 1000)
 
     def command(self, cmd, cmd_data=None):
         ''' send command to roon output/zone'''
@@ -47,13 +125,13 @@ class AlsaVolume(object):
             return False
 
     def _volume_up(self):
-        cur_vol = self._volume_get()
-        self._volume_set(cur_vol + 2)
+        cur_vol = self.volume
+        self._volume_set(min(100, cur_vol + VOLUME_STEP))
         return True
 
     def _volume_down(self):
-        cur_vol = self._volume_get()
-        self._volume_set(cur_vol - 2)
+        cur_vol = self.volume
+        self._volume_set(max(0, cur_vol - VOLUME_STEP))
         return True
 
     def _volume_set(self, volume_level):
@@ -61,21 +139,48 @@ class AlsaVolume(object):
         volume_level = int(volume_level)
         if volume_level < 0 or volume_level > 100:
             return False
-        # we use amixer so we don't have to deal with the logic to calculate hardware values vs percentages
-        percent_str = str(volume_level) + "%"
-        subprocess.call(["/usr/bin/amixer", "-q", "-M", "set", self.monitor.config["ALSA_VOLUME_CONTROL"], percent_str])
+        mixer = self._get_mixer()
+        self._invalidate_volume_cache()
+        if mixer:
+            mixer.set_volume(volume_level)
+        else:
+            # fallback to amixer so we don't have to deal with the logic to calculate hardware values vs percentages
+            percent_str = str(volume_level) + "%"
+            subprocess.call(["/usr/bin/amixer", "-q", "-M", "set", self.monitor.config["ALSA_VOLUME_CONTROL"], percent_str])
         self.monitor.states["player"]["volume_level"] = volume_level
         return True
 
     def _volume_get(self):
         ''' get current volume level of player'''
+        mixer = self._get_mixer()
+        if mixer:
+            return mixer.get_volume()
         volume = 0
-        # we use amixer so we don't have to deal with the logic to calculate hardware values vs percentages
+        # fallback to amixer so we don't have to deal with the logic to calculate hardware values vs percentages
         result = subprocess.check_output("amixer sget %s -M | grep 'Left:' | awk -F'[][]' '{ print $2 }'" % self.monitor.config["ALSA_VOLUME_CONTROL"], shell=True)
         if result:
             volume = int(result.split("%")[0])
         return volume
 
+    def _get_mixer(self):
+        ''' get (or open) the in-process handle to the selected mixer control, returns None if not available'''
+        if self._mixer:
+            return self._mixer
+        control = self.monitor.config["ALSA_VOLUME_CONTROL"]
+        if not control or control == VOLUME_CONTROL_DISABLED:
+            return None
+        try:
+            self._mixer = MixerControl(control)
+            LOGGER.debug("opened alsa mixer control %s" % control)
+            # let the watcher thread pick up the new mixer handle
+            self._wakeup()
+        except Exception as exc:
+            # the control can be missing until the (soft)volume device is used for the first time so we retry later
+            if not self._mixer_failed:
+                LOGGER.warning("unable to open alsa mixer control %s, falling back to amixer - %s" % (control, exc))
+            self._mixer_failed = True
+        return self._mixer
+
     def _setup_alsa_config(self):
         ''' get details about the alsa configuration'''
 
@@ -220,3 +325,74 @@ class AlsaVolume(object):
         self.monitor.config["ALSA_VOLUME_CONTROL"] = selected_mixer
         self.monitor.config["ALSA_CAPTURE_DEVICE"] = selected_capture_device
 
+
+
+class MixerControl(object):
+    '''
+        in-process access to an alsa mixer control
+        volume levels are mapped to percentages the same way as amixer -M does
+    '''
+
+    def __init__(self, control, device="default"):
+        self._lock = threading.Lock()
+        self._mixer = alsaaudio.Mixer(control, device=device)
+        self._units = alsaaudio.VOLUME_UNITS_DB
+        try:
+            self._min, self._max = self._mixer.getrange(units=self._units)
+        except alsaaudio.ALSAAudioError:
+            self._min = self._max = 0
+        if self._min >= self._max:
+            # control has no dB information, use the raw range instead
+            self._units = alsaaudio.VOLUME_UNITS_RAW
+            self._min, self._max = self._mixer.getrange(units=self._units)
+        if self._min >= self._max:
+            raise ValueError("mixer control %s has no usable volume range" % control)
+        self._linear = self._units == alsaaudio.VOLUME_UNITS_RAW or self._max - self._min <= MAX_LINEAR_DB_SCALE * 100
+        self._min_norm = 0.0
+        if not self._linear and self._min != SND_CTL_TLV_DB_GAIN_MUTE:
+            self._min_norm = math.pow(10, (self._min - self._max) / 6000.0)
+
+    def polldescriptors(self):
+        with self._lock:
+            return self._mixer.polldescriptors()
+
+    def handle_events(self):
+        ''' process pending mixer events so the new values can be read'''
+        with self._lock:
+            return self._mixer.handleevents()
+
+    def get_mute(self):
+        ''' get mute state (first channel), controls without a playback switch are never muted'''
+        with self._lock:
+            try:
+                return bool(self._mixer.getmute()[0])
+            except alsaaudio.ALSAAudioError:
+                return False
+
+    def get_volume(self):
+        ''' get volume level as mapped percentage (first channel)'''
+        with self._lock:
+            value = self._mixer.getvolume(units=self._units)[0]
+        return int(round(self._normalize(value) * 100))
+
+    def set_volume(self, volume_level):
+        ''' set mapped volume percentage on all channels'''
+        value = self._denormalize(volume_level / 100.0)
+        with self._lock:
+            self._mixer.setvolume(value, units=self._units)
+
+    def _normalize(self, value):
+        ''' convert raw or dB (1/100) value to 0..1 '''
+        if self._linear:
+            return (value - self._min) / float(self._max - self._min)
+        normalized = math.pow(10, (value - self._max) / 6000.0)
+        return max(0.0, (normalized - self._min_norm) / (1 - self._min_norm))
+
+    def _denormalize(self, volume):
+        ''' convert 0..1 to raw or dB (1/100) value '''
+        if self._linear:
+            return int(round(volume * (self._max - self._min))) + self._min
+        volume = volume * (1 - self._min_norm) + self._min_norm
+        if volume <= 0:
+            return self._min
+        return max(self._min, int(round(6000.0 * math.log10(volume))) + self._max)
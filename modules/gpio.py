@@ -97,7 +97,7 @@ class GPIO(object):
             self._pins_out.append(self.config["GPIO_BUZZER_PIN"])
         if self.config["GPIO_AUDIO_RELAY_PIN"]:
             self._pins_out.append(self.config["GPIO_AUDIO_RELAY_PIN"])
-            self.monitor.register_state_callback(self.state_changed_event, "player")
+            self.monitor.register_state_callback(self.state_changed_event, "player", "power")
 
         for pin in self._pins_out:
             LOGGER.debug("Initialising gpio output pin %s..." % (pin))
@@ -107,8 +107,8 @@ class GPIO(object):
                     self._gpio.output(pin, 1)
             self._update_state(pin)
 
-    def state_changed_event(self, key, value=None, subkey=None):
-        if key == "player" and subkey == "power":
+    def state_changed_event(self, key, value=None, subkey=None, changes=None):
+        if key == "player" and "power" in changes:
             self.set_audio_relay(self.states["player"]["power"])
 
     def stop(self):
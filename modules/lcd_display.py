@@ -29,7 +29,7 @@ class LCDDisplay(threading.Thread):
               charmap='A02',
               auto_linebreaks=True,
               backlight_enabled=True)
-        self.monitor
+        self.monitor = monitor
         self.monitor.register_state_callback(self.state_changed_event, "player")
         threading.Thread.__init__(self)
         
@@ -53,13 +53,13 @@ class LCDDisplay(threading.Thread):
         self.lcd.backlight_enabled = True
         self.lcd.clear()
 
-    def state_changed_event(self, key, value=None, subkey=None):
-        if key == "player" and subkey == "power":
+    def state_changed_event(self, key, value=None, subkey=None, changes=None):
+        if key == "player" and "power" in changes:
             if self.monitor.states["player"]["power"]:
                 self.enable_lcd()
             else:
                 self.disable_lcd()
-        elif key == "player" and subkey == "details":
+        elif key == "player" and set(["state", "artist", "title"]).intersection(changes):
             self.update_display_info()
 
     def update_display_info(self):
@@ -71,8 +71,8 @@ class LCDDisplay(threading.Thread):
             artist = ""
             title = "STOPPED"
         else:
-            artist = player_info["details"]["artist"]
-            title = player_info["details"]["title"]
+            artist = player_info["artist"]
+            title = player_info["title"]
         # update display info
         self.lcd.clear()
         _artist = artist[:39]
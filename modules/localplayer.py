@@ -25,6 +25,7 @@ def setup(monitor):
 class LocalPlayer(object):
     _exit = threading.Event()
     _sox_proc = None
+    _play_thread = None
     _playing = False
 
     def __init__(self, monitor):
@@ -62,12 +63,20 @@ class LocalPlayer(object):
             return False
 
     def play_media(self, url, loop=False, playback_state=PLAYING_STATE):
-        ''' play media file with local sox player '''
+        ''' play media file with local sox player, in the background so stop/pause commands are not blocked'''
         LOGGER.debug("play_media: %s - loop: %s" %(url, loop))
         self._stop_playing()
         self._playing = True
-        self.monitor.states["localplayer"]["state"] = playback_state
-        self.monitor.states["localplayer"]["title"] = url # todo: extract metadata from playing file?
+        self.monitor.states["localplayer"].update({
+                "state": playback_state,
+                "title": url # todo: extract metadata from playing file?
+            })
+        self._play_thread = threading.Thread(target=self._play, args=(url, loop), name="localplayer")
+        self._play_thread.daemon = True
+        self._play_thread.start()
+
+    def _play(self, url, loop):
+        ''' run sox until the media ends (or forever when looping) or we're stopped'''
         args = ["/usr/bin/play", url]
         retries = 10
         while self._playing and not self._exit.isSet():
@@ -86,9 +95,21 @@ class LocalPlayer(object):
     def _stop_playing(self):
         ''' make sure that any playing sox player stops playing '''
         self._playing = False
-        if self._sox_proc:
+        self._terminate_sox()
+        play_thread = self._play_thread
+        if play_thread and play_thread is not threading.current_thread():
+            # wait for it, so it can't overwrite the state of the next playback
+            play_thread.join(1)
+            if play_thread.is_alive():
+                # sox was (re)started right after we terminated it
+                self._terminate_sox()
+                play_thread.join(4)
+
+    def _terminate_sox(self):
+        sox_proc = self._sox_proc
+        if sox_proc:
             try:
-                self._sox_proc.terminate()
+                sox_proc.terminate()
             except OSError:
                 pass
         
\ No newline at end of file
@@ -26,6 +26,7 @@ def setup(monitor):
     monitor.config.get("MQTT_QOS", 1)
     monitor.config.get("MQTT_RETAIN", False)
     monitor.config.get("MQTT_CLEAN_SESSION", False)
+    monitor.config.get("MQTT_PUBLISH_DELTA", False)
     # conditional import of globals
     import_or_install("paho.mqtt.client", "Client", True, installpip="paho-mqtt")
     return MQTT(monitor)
@@ -53,13 +54,20 @@ class MQTT(threading.Thread):
         while not self._exit.isSet():
             self._exit.wait(3600) # keep thread alive
 
-    def state_event(self, key, value, subkey=None):
+    def state_event(self, key, value, subkey=None, changes=None):
         ''' callback if one of the states changes we are listening for'''
         if not key in self.monitor.states:
             return
-        value = self.monitor.states[key]
         topic = "%s/%s" %(self.config["MQTT_TOPIC_STAT"], key)
-        self.publish(topic, value, retain=False)
+        if changes and self.config["MQTT_PUBLISH_DELTA"]:
+            # only publish the changed values, each to its own subtopic
+            for changed_key, new_value in changes.new_values.items():
+                if changed_key == key:
+                    self.publish(topic, new_value, retain=False)
+                else:
+                    self.publish("%s/%s" % (topic, changed_key), new_value, retain=False)
+        else:
+            self.publish(topic, self.monitor.states[key], retain=False)
         
     def stop(self):
         self._exit.set()
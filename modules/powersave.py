@@ -38,8 +38,8 @@ class PowerSave(object):
     def start(self):
         self.monitor.register_state_callback(self.state_changed_event, "player")
 
-    def state_changed_event(self, key, value=None, subkey=None):
-        if key == "player" and subkey == "power":
+    def state_changed_event(self, key, value=None, subkey=None, changes=None):
+        if key == "player" and "power" in changes:
             player_powered = self.monitor.states["player"]["power"]
             if player_powered:
                 # player is powered, disable powersave
@@ -47,7 +47,7 @@ class PowerSave(object):
             else:
                 # player is not powered, enable powersave
                 self._enable_powersave()
-        elif key == "player" and subkey == "state" and self.monitor.config["AUTO_POWER_OFF_WHEN_IDLE_SECONDS"]:
+        if key == "player" and "state" in changes and self.monitor.config["AUTO_POWER_OFF_WHEN_IDLE_SECONDS"]:
             if self.monitor.states["player"]["state"] in IDLE_STATES and self.monitor.states["player"]["power"]:
                 self._interrupted = False
                 thread.start_new_thread(self.watch_paused_state,())
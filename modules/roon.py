@@ -119,7 +119,7 @@ class RoonPlayer(threading.Thread):
         if self.monitor.config.get("ROON_ENABLE_SOURCE_CONTROL", True):
             # register this player as a source control in Roon
             self._roonapi.register_source_control(HOSTNAME, HOSTNAME, self._roon_source_control_callback, "standby")
-        self.monitor.register_state_callback(self._monitor_state_changed_event, "player")
+        self.monitor.register_state_callback(self._monitor_state_changed_event, "player", "power")
 
         # some players need to be unmuted when freshly started
         if self.output_id:
@@ -136,9 +136,9 @@ class RoonPlayer(threading.Thread):
 
     #### PRIVATE CLASS METHODS #######
 
-    def _monitor_state_changed_event(self, key, value=None, subkey=None):
+    def _monitor_state_changed_event(self, key, value=None, subkey=None, changes=None):
         ''' we registered to receive state changed events'''
-        if key == "player" and subkey == "power":
+        if key == "player" and "power" in changes:
             player_powered = self.monitor.states["player"]["power"]
             if self.monitor.config["ROON_ENABLE_SOURCE_CONTROL"]:
                 if player_powered and self.monitor.states["player"]["current_player"] == "roon":
@@ -175,6 +175,11 @@ class RoonPlayer(threading.Thread):
             LOGGER.debug("unable to detect Roon output ID, skip for now...")
         return output_id
 
+    @property
+    def volume(self):
+        ''' current volume level of the output'''
+        return self._get_volume()
+
     def _set_volume(self, volume_level):
         ''' set volume level '''
         return self._roonapi.change_volume(self.output_id, volume_level)
@@ -193,25 +198,31 @@ class RoonPlayer(threading.Thread):
     def _update_metadata(self):
         zone_details = self._roonapi.zone_by_output_name(self.player_name)
         state = zone_details["state"] if zone_details else "off"
-        if zone_details and zone_details.get("now_playing"):
-            zone_details = zone_details["now_playing"]
-            img = self._roonapi.get_image(zone_details["image_key"]) if "image_key" in zone_details else ""
-            self.monitor.states["roon"].update({
-                    "state": state,
-                    "volume_level": self._get_volume(),
-                    "artist": zone_details["three_line"]["line2"],
-                    "album": zone_details["three_line"]["line3"],
-                    "title": zone_details["three_line"]["line1"],
-                    "duration": zone_details["length"],
-                    "cover_url": img
-                })
-        else:
-            self.monitor.states["roon"].update({
-                    "artist": "",
-                    "album": "",
-                    "title": "",
-                    "duration": 0,
-                    "cover_url": "",
-                    "state": state,
-                    "volume_level": self._get_volume()
-                })
+        player_states = self.monitor.states["roon"]
+        with player_states.transaction():
+            if zone_details and zone_details.get("now_playing"):
+                zone_details = zone_details["now_playing"]
+                img = self._roonapi.get_image(zone_details["image_key"]) if "image_key" in zone_details else ""
+                player_states.update({
+                        "state": state,
+                        "volume_level": self._get_volume(),
+                        "artist": zone_details["three_line"]["line2"],
+                        "album": zone_details["three_line"]["line3"],
+                        "title": zone_details["three_line"]["line1"],
+                        "duration": zone_details["length"],
+                        "cover_url": img
+                    })
+                # zones_changed is sent on track changes, seeks, pause and resume
+                player_states.set_position(zone_details.get("seek_position") or 0)
+            else:
+                player_states.update({
+                        "artist": "",
+                        "album": "",
+                        "title": "",
+                        "duration": 0,
+                        "cover_url": "",
+                        "state": state,
+                        "volume_level": self._get_volume()
+                    })
+                if player_states["position"] or player_states["rate"]:
+                    player_states.set_position(0, False)
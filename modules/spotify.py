@@ -94,27 +94,30 @@ class SpotifyPlayer(threading.Thread):
         ''' event received from socket to librespot'''
         LOGGER.debug("Got event from librespot: %s" % event)
         if event == "metadata":
-            self.monitor.states["spotify"].update({
-                    "title": data["track_name"],
-                    "artist": data["artist_name"],
-                    "album": data["album_name"],
-                    "duration": data["duration_ms"]/1000,
-                    "cover_url": "https://i.scdn.co/image/%s" % data["albumartId"][0] # why do we receive multiple art id's ?
-                })
+            with self.monitor.states["spotify"].transaction():
+                self.monitor.states["spotify"].update({
+                        "title": data["track_name"],
+                        "artist": data["artist_name"],
+                        "album": data["album_name"],
+                        "duration": data["duration_ms"]/1000,
+                        "cover_url": "https://i.scdn.co/image/%s" % data["albumartId"][0] # why do we receive multiple art id's ?
+                    })
+                # new track: it starts at the beginning unless librespot tells us otherwise
+                self.monitor.states["spotify"].set_position(data.get("position_ms", 0) / 1000.0)
         elif event == "token":
             self._token = data
         elif event == "kSpPlaybackNotifyBecameActive":
-            self.monitor.states["spotify"]["state"] = PAUSED_STATE
+            self.monitor.states["spotify"].set_state(PAUSED_STATE)
         elif event == "kSpDeviceActive":
-            self.monitor.states["spotify"]["state"] = PAUSED_STATE
+            self.monitor.states["spotify"].set_state(PAUSED_STATE)
         elif event == "kSpDeviceInactive":
-            self.monitor.states["spotify"]["state"] = STOPPED_STATE
+            self.monitor.states["spotify"].set_state(STOPPED_STATE)
         elif event == "kSpSinkActive":
-            self.monitor.states["spotify"]["state"] = PLAYING_STATE
+            self.monitor.states["spotify"].set_state(PLAYING_STATE)
         elif event == "kSpSinkInactive":
-            self.monitor.states["spotify"]["state"] = PAUSED_STATE
+            self.monitor.states["spotify"].set_state(PAUSED_STATE)
         elif event == "kSpPlaybackNotifyBecameInactive":
-            self.monitor.states["spotify"]["state"] = STOPPED_STATE
+            self.monitor.states["spotify"].set_state(STOPPED_STATE)
 
     def run(self):
         # finally start the librespot executable
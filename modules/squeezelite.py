@@ -5,9 +5,10 @@ import requests
 import thread
 import socket
 import threading
-from resources.lib.utils import PlayerMetaData, json, requests, HOSTNAME, check_software, run_proc, subprocess, DEVNULL, STOPPED_STATE, PLAYING_STATE, PAUSED_STATE, VOLUME_CONTROL_DISABLED
+from resources.lib.utils import PlayerMetaData, json, requests, HOSTNAME, check_software, run_proc, subprocess, DEVNULL, STOPPED_STATE, PLAYING_STATE, PAUSED_STATE, VOLUME_CONTROL_DISABLED, VOLUME_STEP, monotonic
 import re
 import time
+import urllib
 
 def setup(monitor):
     '''setup the module'''
@@ -18,6 +19,12 @@ def setup(monitor):
         LOGGER.warning("Squeezelite is not installed, please install manually.")
         return False
     import uuid
+    monitor.config.get("SQUEEZELITE_LMS_CLI_PORT", 9090)
+    # last known LMS server, tried before discovery
+    monitor.config.get("SQUEEZELITE_LMS_HOST", u"")
+    monitor.config.get("SQUEEZELITE_LMS_PORT", 9000)
+    # uuid of the preferred LMS server if there are multiple servers on the network
+    monitor.config.get("SQUEEZELITE_LMS_UUID", u"")
     player_mac = ':'.join(['{:02x}'.format((uuid.getnode() >> i) & 0xff) for i in range(0,8*6,8)][::-1])
 
     return SqueezelitePlayer(monitor, player_mac)
@@ -26,7 +33,17 @@ def setup(monitor):
 TAGS_FULL = "aAcCdegGijJKlostuxyRwk"  # full track/album details
 TAGS_BASIC = "acdgjKluNxy"  # basic track details for initial listings
 TAGS_ALBUM = "yjtiqwaal"
-LOOP_WAIT = 5
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 2
+HTTP_POOL_SIZE = 2 # the poll loop and the command executor may talk to LMS at the same time
+SUBSCRIBE_EVENTS = "client,playlist,mixer,play,pause,stop,power,time"
+SUBSCRIBE_POLL_INTERVAL = 30 # safety net poll interval when the cli subscription is active
+PROBE_TIMEOUT = 2 # timeout for checking if the last known LMS server is still there
+REDISCOVER_AFTER_FAILURES = 3 # failed polls before we start looking for another server
+DISCOVERY_TAGS = ["NAME", "JSON", "VERS", "UUID"]
+DISCOVERY_GRACE = 0.5 # time to wait for other servers after the first reply
+POSITION_TOLERANCE = 2 # max difference (in seconds) between the reported and extrapolated position
+REQUEST_STATS_INTERVAL = 60 # publish the request stats at most this often, every update is a state event
 
 class SqueezelitePlayer(threading.Thread):
     ''' LMS Class containing our helper methods'''
@@ -37,29 +54,50 @@ class SqueezelitePlayer(threading.Thread):
     _squeezelite_proc = None
     _exit = threading.Event()
     _last_state = None
+    _event_listener = None
+    _subscribed = False
+    _failures = 0
+    _rediscovering = False
+    _last_track = None
 
     def __init__(self, monitor, player_mac):
         self.monitor = monitor
         self._playerid = player_mac
+        self._sessions = {} # (host, port) --> requests session
+        self.request_stats = {"count": 0, "errors": 0, "avg": 0.0, "max": 0.0, "last": 0.0}
+        self._request_stats_published = 0
         self.monitor.states["squeezelite"] = PlayerMetaData("Squeezelite (LMS)")
+        self.monitor.states["lms"] = {"servers": [], "host": "", "port": 0, "name": "", "uuid": "",
+                "requests": dict(self.request_stats)}
         threading.Thread.__init__(self)
 
     def stop(self):
         self._exit.set()
+        self.monitor.scheduler.unregister("squeezelite")
+        if self._event_listener:
+            self._event_listener.stop()
         if self._squeezelite_proc:
             self._squeezelite_proc.terminate()
         threading.Thread.join(self, 2)
+        for session in self._sessions.values():
+            session.close()
+
+    @property
+    def volume(self):
+        ''' current volume level, straight from the server (the states are only refreshed on the next poll)'''
+        result = self.send_request("mixer volume ?", timeout=5)
+        if result and "_volume" in result:
+            return int(float(result["_volume"]))
+        return None
 
     def command(self, cmd, cmd_data=None):
         ''' send command to lms'''
         if cmd == "volume_up":
-            return self._api_execute(
-                    "change_volume_relative", {"volume":2, "output": self.output_id})
+            return self.send_request("mixer volume +%s" % VOLUME_STEP) is not None
         elif cmd == "volume_down":
-            return self._api_execute(
-                    "change_volume_relative", {"volume":-2, "output": self.output_id})
+            return self.send_request("mixer volume -%s" % VOLUME_STEP) is not None
         elif cmd == "volume_set":
-            return self._set_volume(cmd_data)
+            return self.send_request("mixer volume %s" % int(cmd_data)) is not None
         elif cmd == "next":
             return self.send_request("playlist jump +1")
         elif cmd == "previous":
@@ -87,72 +125,188 @@ class SqueezelitePlayer(threading.Thread):
             self._squeezelite_proc = subprocess.Popen(args)
         else:
             self._squeezelite_proc = subprocess.Popen(args, stdout=DEVNULL, stderr=subprocess.STDOUT)
-        # auto discover LMS server....
-        lmsserver = None
-        while not lmsserver and not self._exit.isSet():
-            LOGGER.info("disovering LMS server ...")
-            servers = LMSDiscovery().all()
-            if servers:
-                lmsserver = servers[0]  # for now, just use the first server discovered
-                break
-            else:
+        # try the last known LMS server first, auto discover only if it doesn't answer
+        if not self._connect_cached_server():
+            while not self._exit.isSet() and not self._discover_server():
                 self._exit.wait(2)
-        if lmsserver:
-            self._host = lmsserver["host"]
-            self._port = lmsserver["port"]
-            LOGGER.info("LMS server discovered - host: %s - port: %s" % (self._host, self._port))
-        else:
+        if self._exit.isSet():
             return
-        # main loop
-        while not self._exit.isSet():
-            cur_state = self._get_state()
+        # LMS pushes the player events over the cli, polling is only a fallback if that fails
+        self._register_poll_job()
+        self._start_event_listener()
+
+    def _connect_cached_server(self):
+        ''' check if the LMS server we used last time is still available'''
+        host = self.monitor.config["SQUEEZELITE_LMS_HOST"]
+        if not host:
+            return False
+        self._host = host
+        self._port = self.monitor.config["SQUEEZELITE_LMS_PORT"]
+        preferred_uuid = self.monitor.config["SQUEEZELITE_LMS_UUID"]
+        status = self.send_request("serverstatus 0 0", timeout=PROBE_TIMEOUT)
+        if status is None:
+            LOGGER.info("Last known LMS server %s:%s is not available" % (self._host, self._port))
+        elif preferred_uuid and status.get("uuid") != preferred_uuid:
+            LOGGER.info("Last known LMS server %s:%s is not the preferred server" % (self._host, self._port))
+        else:
+            LOGGER.info("Using last known LMS server - host: %s - port: %s" % (self._host, self._port))
+            self.monitor.states["lms"].update({"host": self._host, "port": self._port, 
+                    "uuid": status.get("uuid", ""), "name": ""})
+            return True
+        self._host = None
+        self._port = None
+        return False
+
+    def _discover_server(self):
+        ''' discover a LMS server on the network and remember it for the next start'''
+        LOGGER.info("discovering LMS server ...")
+        discovery = LMSDiscovery()
+        lmsserver = discovery.best(self.monitor.config["SQUEEZELITE_LMS_UUID"])
+        servers = [dict((key, value) for key, value in entry.items() if key != "from") 
+                for entry in discovery.entries]
+        self.monitor.states["lms"]["servers"] = servers
+        if not lmsserver:
+            return False
+        self._host = lmsserver["host"]
+        self._port = lmsserver["port"]
+        if (self.monitor.config["SQUEEZELITE_LMS_HOST"], self.monitor.config["SQUEEZELITE_LMS_PORT"]) != (self._host, self._port):
+            self.monitor.config["SQUEEZELITE_LMS_HOST"] = self._host
+            self.monitor.config["SQUEEZELITE_LMS_PORT"] = self._port
+            # write it to disk right away, a Pi is usually stopped by pulling the plug
+            self.monitor.command("system", "persistconfig")
+        self.monitor.states["lms"].update({"host": self._host, "port": self._port, 
+                "uuid": lmsserver["uuid"], "name": lmsserver["name"]})
+        LOGGER.info("LMS server discovered - name: %s - host: %s - port: %s - latency: %.1f ms" % 
+                (lmsserver["name"], self._host, self._port, lmsserver["latency"] * 1000))
+        return True
+
+    def _rediscover(self):
+        ''' background discovery while the current server does not answer'''
+        try:
+            prev_server = (self._host, self._port)
+            while self._failures and not self._exit.isSet():
+                if self._discover_server():
+                    if (self._host, self._port) != prev_server:
+                        self._start_event_listener()
+                        self.monitor.scheduler.trigger("squeezelite")
+                    break
+                self._exit.wait(10)
+        finally:
+            self._rediscovering = False
+
+    def _start_event_listener(self):
+        if self._event_listener:
+            self._event_listener.stop()
+            if self._subscribed:
+                self._subscribed = False
+                self._register_poll_job()
+        self._event_listener = LMSEventListener(self._host, self.monitor.config["SQUEEZELITE_LMS_CLI_PORT"],
+                self._playerid, self._on_lms_event)
+        self._event_listener.start()
+
+    def _register_poll_job(self):
+        ''' (re)register our poll job, with long intervals if LMS pushes the events to us'''
+        if self._subscribed:
+            min_interval, max_interval = SUBSCRIBE_POLL_INTERVAL, SUBSCRIBE_POLL_INTERVAL
+        else:
+            min_interval, max_interval = POLL_INTERVAL_MIN, POLL_INTERVAL_MAX
+        self.monitor.scheduler.register("squeezelite", self._poll_status, min_interval, max_interval, 
+                is_active=lambda: self._last_state == PLAYING_STATE)
+
+    def _on_lms_event(self):
+        ''' called by the cli listener for events of our player and when the connection changes'''
+        if self._event_listener.connected != self._subscribed:
+            self._subscribed = self._event_listener.connected
+            self._register_poll_job()
+        self.monitor.scheduler.trigger("squeezelite")
+
+    def _poll_status(self):
+        ''' poll job: returns True if the player state changed'''
+        # a single status request gives us both the player mode and the metadata
+        status = self.send_request("status - 1 tags:%s" % TAGS_BASIC)
+        cur_state = self._get_state(status)
+        player_states = self.monitor.states["squeezelite"]
+        prev_revision = player_states.revision
+        with player_states.transaction():
             if cur_state != self._last_state:
                 self._last_state = cur_state
-                self.monitor.states["squeezelite"]["state"] = cur_state
-                self._update_metadata()
-            if cur_state == "playing":
-                self._update_metadata()
-                LOOP_WAIT = 0.5
-            else:
-                LOOP_WAIT = 2
-            self._exit.wait(LOOP_WAIT)
+                player_states.set_state(cur_state)
+            # also while paused or stopped: volume changes and track skips (the polls are triggered by LMS events),
+            # only the values that really changed are applied
+            self._update_metadata(status)
+        if status is None:
+            self._failures += 1
+            if self._failures >= REDISCOVER_AFTER_FAILURES and not self._rediscovering:
+                # the server may have moved to another address
+                self._rediscovering = True
+                rediscover_thread = threading.Thread(target=self._rediscover)
+                rediscover_thread.daemon = True
+                rediscover_thread.start()
+            raise IOError("LMS server %s:%s did not respond" % (self._host, self._port))
+        self._failures = 0
+        self._publish_request_stats()
+        return player_states.revision != prev_revision
 
-    def _get_state(self):
-        '''set the current status of the player'''
+    @staticmethod
+    def _get_state(status):
+        '''get the current state of the player from the status response'''
         result = ""
-        status = self.send_request("mode ?")
-        if status and "_mode" in status:
-            if status["_mode"] == "stop":
+        if status and "mode" in status:
+            if status["mode"] == "stop":
                 result = STOPPED_STATE
-            elif status["_mode"] == "play":
+            elif status["mode"] == "play":
                 result = PLAYING_STATE
-            elif status["_mode"] == "pause":
+            elif status["mode"] == "pause":
                 result = PAUSED_STATE
             else:
-                result = status["_mode"]
+                result = status["mode"]
         return result
 
-    def _update_metadata(self):
-        status = self.send_request("status - 1 tags:%s" % TAGS_BASIC)
-        if status and not "error" in status:
-            self.monitor.states["squeezelite"]["volume_level"] = status["mixer volume"]
-            self.monitor.states["squeezelite"]["repeat"] = status["playlist repeat"] != 0
-            self.monitor.states["squeezelite"]["shuffle"] = status["playlist shuffle"] != 0
-            if status.get("playlist_loop"):
-                track_details = status["playlist_loop"][0]
-                self.monitor.states["squeezelite"]["artist"] = track_details["artist"]
-                self.monitor.states["squeezelite"]["album"] = track_details["album"]
-                self.monitor.states["squeezelite"]["title"] = track_details["title"]
-                self.monitor.states["squeezelite"]["duration"] = track_details["duration"]/1000
-                self.monitor.states["squeezelite"]["cover_url"] = self._get_thumb(track_details)
+    def _update_metadata(self, status):
+        ''' apply the changes in the status response, the track details are only processed if the track changed'''
+        if not status or "error" in status:
+            return
+        player_states = self.monitor.states["squeezelite"]
+        metadata = {
+            "volume_level": status["mixer volume"],
+            "repeat": status["playlist repeat"] != 0,
+            "shuffle": status["playlist shuffle"] != 0
+        }
+        track_details = status["playlist_loop"][0] if status.get("playlist_loop") else {}
+        # the title is part of the key because radio streams keep the same track id
+        track_key = (status.get("playlist_cur_index"), track_details.get("id"), track_details.get("title"))
+        track_changed = track_key != self._last_track
+        if track_changed:
+            self._last_track = track_key
+            if track_details:
+                metadata.update({
+                    "artist": track_details["artist"],
+                    "album": track_details["album"],
+                    "title": track_details["title"],
+                    "duration": track_details.get("duration", 0),
+                    "cover_url": self._get_thumb(track_details)
+                })
             else:
-                self.monitor.states["squeezelite"]["artist"] = ""
-                self.monitor.states["squeezelite"]["album"] = ""
-                self.monitor.states["squeezelite"]["title"] = ""
-                self.monitor.states["squeezelite"]["duration"] = ""
-                self.monitor.states["squeezelite"]["cover_url"] = ""
+                metadata.update({
+                    "artist": "",
+                    "album": "",
+                    "title": "",
+                    "duration": "",
+                    "cover_url": ""
+                })
+        # only the real changes are applied, broadcasted as a single event
+        changes = dict((key, value) for key, value in metadata.items() if player_states.get(key) != value)
+        if changes:
+            player_states.update(changes)
+        # the position is only published if it differs from the extrapolated position,
+        # which is the case on a seek, pause, resume or new track
+        playing = status.get("mode") == "play"
+        position = status.get("time", 0) if track_details else 0
+        if (track_changed or (player_states["rate"] > 0) != playing or 
+                abs(player_states.current_position - position) > POSITION_TOLERANCE):
+            player_states.set_position(position, playing)
 
-    def send_request(self, cmd):
+    def send_request(self, cmd, timeout=20):
         '''send request to lms server'''
         if isinstance(cmd, (str, unicode)):
             if "[SP]" in cmd:
@@ -165,15 +319,15 @@ class SqueezelitePlayer(threading.Thread):
         url = "http://%s:%s/jsonrpc.js" % (self._host, self._port)
         cmd = [self._playerid, cmd]
         params = {"id": 1, "method": "slim.request", "params": cmd}
-        result = self.get_json(url, params)
+        result = self.get_json(url, params, timeout)
         return result
 
-    @staticmethod
-    def get_json(url, params):
-        '''get info from json api'''
-        result = {}
+    def get_json(self, url, params, timeout=20):
+        '''get info from json api, returns None if the request failed'''
+        result = None
+        start = time.time()
         try:
-            response = requests.get(url, data=json.dumps(params), timeout=20)
+            response = self._get_session().post(url, data=json.dumps(params), timeout=timeout)
             if response and response.content and response.status_code == 200:
                 result = json.loads(response.content.decode('utf-8', 'replace'))
                 if "result" in result:
@@ -183,10 +337,45 @@ class SqueezelitePlayer(threading.Thread):
                         (response.status_code))
         except Exception as exc:
             LOGGER.error("Server is offline or connection error... %s" % exc)
-
+            # the pooled connection may be broken, start over with a fresh one
+            self._close_session()
+        self._update_request_stats(time.time() - start, result is None)
         #log_msg("%s --> %s" %(params, result))
         return result
 
+    def _get_session(self):
+        '''get the http session (keep-alive connection pool) for the current LMS server'''
+        server = (self._host, self._port)
+        session = self._sessions.get(server)
+        if not session:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            self._sessions[server] = session
+        return session
+
+    def _close_session(self):
+        session = self._sessions.pop((self._host, self._port), None)
+        if session:
+            session.close()
+
+    def _update_request_stats(self, duration, failed):
+        stats = self.request_stats
+        stats["avg"] = (stats["avg"] * stats["count"] + duration) / (stats["count"] + 1)
+        stats["count"] += 1
+        stats["last"] = duration
+        if duration > stats["max"]:
+            stats["max"] = duration
+        if failed:
+            stats["errors"] += 1
+
+    def _publish_request_stats(self):
+        ''' the stats of the requests to LMS (through the keep-alive session pool) in states["lms"]["requests"]'''
+        if monotonic() - self._request_stats_published < REQUEST_STATS_INTERVAL:
+            return
+        self._request_stats_published = monotonic()
+        self.monitor.states["lms"]["requests"] = dict(self.request_stats)
+
     def _get_thumb(self, item):
         '''get thumb url from the item's properties'''
         thumb = ""
@@ -223,6 +412,66 @@ class SqueezelitePlayer(threading.Thread):
 
 
 
+class LMSEventListener(threading.Thread):
+    ''' subscribe to the player events on the LMS cli (telnet) interface'''
+    _sock = None
+    connected = False
+
+    def __init__(self, host, port, playerid, callback):
+        self._exit = threading.Event() # per instance, the listener is replaced when the server changes
+        self._host = host
+        self._port = port
+        # the cli sends the player id url encoded
+        self._playerid = urllib.quote(playerid).lower()
+        self._callback = callback
+        threading.Thread.__init__(self)
+
+    def stop(self):
+        self._exit.set()
+        self._disconnect()
+        threading.Thread.join(self, 2)
+
+    def run(self):
+        while not self._exit.isSet():
+            try:
+                self._sock = socket.create_connection((self._host, self._port), 10)
+                self._sock.settimeout(None)
+                self._sock.sendall("subscribe %s\n" % SUBSCRIBE_EVENTS)
+                self.connected = True
+                LOGGER.info("Subscribed to player events on LMS cli %s:%s" % (self._host, self._port))
+                # trigger an update for the events we may have missed while not connected
+                self._callback()
+                self._listen()
+            except (socket.error, IOError) as exc:
+                if not self._exit.isSet():
+                    LOGGER.warning("LMS cli connection failed, falling back to polling... %s" % exc)
+            self._disconnect()
+            if not self._exit.isSet():
+                self._callback()
+            self._exit.wait(30)
+
+    def _listen(self):
+        ''' read the event lines, the callback is called for events of our player'''
+        sock_file = self._sock.makefile("rb")
+        try:
+            for line in iter(sock_file.readline, ""):
+                if line.split(" ", 1)[0].lower() == self._playerid:
+                    self._callback()
+        finally:
+            sock_file.close()
+
+    def _disconnect(self):
+        self.connected = False
+        sock = self._sock
+        self._sock = None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except socket.error:
+                pass
+
+
 class LMSDiscovery(object):
     """Class to discover Logitech Media Servers connected to your network."""
 
@@ -241,32 +490,83 @@ class LMSDiscovery(object):
         self.scan()
         return list(self.entries)
 
-    def update(self):
-        """update the server netry with details"""
+    def best(self, uuid=None):
+        """
+            Scan and return the preferred server (by uuid) or the one with the lowest latency.
+            Returns as soon as the preferred server answers or shortly after the first reply.
+        """
+        with self._lock:
+            self.update(uuid=uuid, grace=DISCOVERY_GRACE)
+            entries = list(self.entries)
+        for entry in entries:
+            if uuid and entry["uuid"] == uuid:
+                return entry
+        if uuid and entries:
+            LOGGER.warning("Preferred LMS server %s not found, using the fastest server" % uuid)
+        return min(entries, key=lambda entry: entry["latency"]) if entries else None
+
+    def update(self, uuid=None, grace=None):
+        """
+            update the server entries with details
+            if grace is set, stop listening that many seconds after the first reply 
+            (or right away when the server with the given uuid replied)
+        """
         lms_ip = '<broadcast>'
         lms_port = 3483
-        # JSON tag has the port number, it's all we need here.
-        lms_msg = "eJSON\0"
+        # request the details we need as TLV's, the tags have an empty value in the request
+        lms_msg = "e" + "".join("%s\0" % tag for tag in DISCOVERY_TAGS)
         lms_timeout = 5
         entries = []
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.settimeout(lms_timeout)
         sock.bind(('', 0))
         try:
+            sent = time.time()
+            deadline = sent + lms_timeout
             sock.sendto(lms_msg, (lms_ip, lms_port))
             while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                sock.settimeout(timeout)
                 try:
                     data, server = sock.recvfrom(1024)
-                    host, _ = server
-                    if data.startswith(b'E'):
-                        port = data.split("\x04")[1]
-                        entries.append({'port': int(port),
-                                        'data': data,
-                                        'from': server,
-                                        'host': host})
                 except socket.timeout:
                     break
+                latency = time.time() - sent
+                entry = self.parse_reply(data)
+                if not entry or any(item["from"] == server for item in entries):
+                    continue # not a valid reply or a duplicate
+                entry.update({"from": server, "host": server[0], "latency": latency})
+                entries.append(entry)
+                if uuid and entry["uuid"] == uuid:
+                    break
+                if grace is not None and len(entries) == 1:
+                    deadline = min(deadline, time.time() + grace)
         finally:
             sock.close()
-        self.entries = entries
\ No newline at end of file
+        self.entries = entries
+        self.last_scan = time.time()
+
+    @staticmethod
+    def parse_reply(data):
+        """parse the TLV's (4 char tag, 1 byte length, value) of a discovery reply, None if it's not valid"""
+        if not data.startswith(b'E'):
+            return None
+        tlvs = {}
+        pos = 1
+        while pos + 5 <= len(data):
+            tag = data[pos:pos+4]
+            length = ord(data[pos+4])
+            tlvs[tag] = data[pos+5:pos+5+length].decode("utf-8", "replace")
+            pos += 5 + length
+        try:
+            port = int(tlvs["JSON"])
+        except (KeyError, ValueError):
+            return None
+        return {
+            "port": port,
+            "name": tlvs.get("NAME", ""),
+            "uuid": tlvs.get("UUID", ""),
+            "version": tlvs.get("VERS", "")
+        }
@@ -7,7 +7,7 @@ import time
 import threading
 
 
-LOOP_WAIT = 600
+POLL_INTERVAL = 600
 
 
 def setup(monitor):
@@ -25,11 +25,16 @@ class SystemState(threading.Thread):
         
     def stop(self):
         self._exit.set()
+        self.monitor.scheduler.unregister("systemstate")
         threading.Thread.join(self, 2)
 
     def update_states(self):
-        self.monitor.states["systemstate"]["cputemp"] = self._get_cputemp()
+        '''poll job: returns True if any of the states changed'''
+        cputemp = self._get_cputemp()
+        changed = cputemp != self.monitor.states["systemstate"]["cputemp"]
+        self.monitor.states["systemstate"]["cputemp"] = cputemp
         # TODO: add some more to monitor
+        return changed
 
     def _get_cputemp(self):
         cputemp = 0
@@ -44,6 +49,4 @@ class SystemState(threading.Thread):
 
 
     def run(self):
-        while not self._exit.isSet():
-            cputemp = self.update_states()
-            self._exit.wait(LOOP_WAIT)
\ No newline at end of file
+        self.monitor.scheduler.register("systemstate", self.update_states, POLL_INTERVAL, POLL_INTERVAL)
\ No newline at end of file
@@ -7,7 +7,40 @@ import sys
 import time
 import threading
 import logging
-from resources.lib.utils import json, DEVNULL, requests, LOGGER, import_or_install, run_proc
+import socket
+import select
+import errno
+import fcntl
+import urlparse
+import binascii
+from collections import deque
+from resources.lib.utils import json, DEVNULL, requests, LOGGER, import_or_install, run_proc, monotonic
+from resources.lib.coverart import guess_mimetype
+from resources.lib.logreader import read_range, read_tail
+
+LOG_FILE = "/tmp/pi-monitor.log"
+WEBCONFIG_PORT = 80
+# revisions start over when we restart, everything we hand out based on them (etags, event ids) is unique per run
+# random: the clock of a Pi without RTC is restored from fake-hwclock and may repeat after a reboot
+RUN_ID = binascii.hexlify(os.urandom(8))
+
+
+def make_revision_id(revision):
+    ''' the id of a state revision as handed out to the clients (event ids, sync points)'''
+    return "%s-%s" % (RUN_ID, revision)
+
+
+def parse_revision_id(revision_id, cur_revision):
+    ''' the revision of an id we handed out, 0 if it's invalid or from another run (a full sync is needed)'''
+    run_id, _, revision = (revision_id or "").rpartition("-")
+    try:
+        revision = int(revision)
+    except ValueError:
+        return 0
+    if run_id != RUN_ID or not 0 < revision <= cur_revision:
+        return 0
+    return revision
+LOG_TAIL_LINES = 200 # lines shown when the log page is opened
 
 
 def setup(monitor):
@@ -15,10 +48,11 @@ def setup(monitor):
     if not monitor.config.get("ENABLE_MODULE_WEBCONFIG", True):
         LOGGER.debug("Webconfig module is not enabled!")
         return False
-    import_or_install("flask", ["Flask", "render_template", "flash", "request", "send_file", "redirect", "jsonify"], True, installpip="Flask")
+    import_or_install("flask", ["Flask", "render_template", "flash", "request", "send_file", "redirect", "jsonify", "Response"], True, installpip="Flask")
     import_or_install("wtforms", ["StringField", "TextAreaField", "StringField", "SubmitField", "BooleanField", "IntegerField", "FloatField", "SelectField"], True, installpip="WTForms")
     import_or_install("flask_wtf", "FlaskForm", True, installpip="")
     import_or_install("bjoern", installpip="bjoern", installapt="libev-dev python-dev")
+    monitor.config.get("WEBCONFIG_STREAM_PORT", 8081)
     return WebConfig(monitor)
 
 
@@ -29,49 +63,87 @@ class WebConfig(threading.Thread):
     def __init__(self, monitor):
         self.config = monitor.config
         self.monitor = monitor
+        self.event_stream = EventStream(monitor, self.config["WEBCONFIG_STREAM_PORT"])
         threading.Thread.__init__(self)
         
     def stop(self):
         self._exit.set()
+        self.event_stream.stop()
         threading.Thread.join(self, 2)
 
+    def conditional_response(self, etag, get_data, mimetype="application/json"):
+        ''' 304 Not Modified if the client already has this etag, otherwise the data (only built when needed)'''
+        etag = "%s-%s" % (RUN_ID, etag)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            data = get_data()
+            response = Response(data, mimetype=mimetype or guess_mimetype(data))
+        response.set_etag(etag)
+        # always revalidate, the urls stay the same when the content changes
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
     def run(self):
         this_dir = os.path.dirname(os.path.abspath(__file__))
         root_path = os.path.join(this_dir, "..", "resources/web/")
         app = Flask(__name__, root_path=root_path)
         app.config.from_object(__name__)
         app.config['SECRET_KEY'] = '7d441f27d441f27567d441f2b6176a'
+        self.event_stream.start()
 
         @app.route('/player_image')
         def player_image():
             player_info = self.monitor.player_info
             if player_info:
-                if player_info.get("cover_file"):
-                    return send_file(player_info["cover_file"], mimetype='image/png')
-                elif player_info.get("cover_art"):
-                    return player_info["cover_art"]
-                elif player_info.get("cover_url"):
-                    if "localhost" in player_info["cover_url"]:
-                        response = requests.get(player_info["cover_url"])
-                        if response.status_code == 200:
-                            return response.content
-                    else:
-                        return redirect(player_info["cover_url"], code=302)
+                # all cover art is served from the (shared) cover cache,
+                # cover urls are downloaded in the background so we never wait for a remote server here
+                cover_id = player_info.get("cover_id")
+                size = request.args.get("size", type=int)
+                if size:
+                    # prebuilt thumbnail, the image is never resized on request
+                    data = self.monitor.cover_cache.get_thumbnail(cover_id, size)
+                else:
+                    data = self.monitor.cover_cache.get(cover_id)
+                if data:
+                    # the checksum identifies the cover, the length tells a thumbnail from the original
+                    return self.conditional_response("%s-%s" % (cover_id, len(data)), lambda: data, None)
             # fallback image
             base_dir = os.path.dirname(os.path.abspath(__file__))
             temp_img = os.path.join(base_dir, "..","resources", "web", "static", "default_cover.png")
-            return send_file(temp_img, mimetype='image/png')
+            return send_file(temp_img, mimetype='image/png', conditional=True)
 
         @app.route('/states')
         @app.route('/states/<key>')
         @app.route('/states/<key>/<subkey>')
         def get_states(key=None, subkey=None):
+            # the revision of the (closest) node bumps on every change within it
             if subkey:
-                return json.dumps(self.monitor.states[key][subkey])
+                node = self.monitor.states[key]
+                value = node[subkey]
+                revision = getattr(value, "revision", getattr(node, "revision", self.monitor.states.revision))
+                return self.conditional_response(revision, lambda: json.dumps(value))
             elif key:
-                return json.dumps(self.monitor.states[key])
+                value = self.monitor.states[key]
+                revision = getattr(value, "revision", self.monitor.states.revision)
+                return self.conditional_response(revision, lambda: json.dumps(value))
             else:
-                return self.monitor.states.json
+                return self.conditional_response(self.monitor.states.revision, lambda: self.monitor.states.json)
+
+        @app.route('/changes/<since>')
+        def get_changes(since=""):
+            # grab the revision first so changes made during this request are also in the next sync
+            cur_revision = self.monitor.states.revision
+            revision = parse_revision_id(since, cur_revision)
+            # an id from before a restart gets everything: our revisions started over
+            changes = self.monitor.states.changes_since(revision) if revision else self.monitor.states
+            return json.dumps({"revision": cur_revision, "id": make_revision_id(cur_revision),
+                    "snapshot": not revision, "changes": changes, "now": monotonic()})
+
+        @app.route('/stats')
+        def get_stats():
+            return json.dumps({"dispatch_latency": self.monitor.dispatch_latency,
+                    "commands": self.monitor.states["commands"]})
 
         @app.route('/command')
         @app.route('/command/<target>')
@@ -90,15 +162,25 @@ class WebConfig(threading.Thread):
                 flash('Error while executing command')
                 return "command is empty"
 
+        @app.route("/log")
+        def get_log():
+            # either the last lines or a byte range, the log file is never read as a whole
+            offset = request.args.get("offset", type=int)
+            if offset is None:
+                data, offset, size = read_tail(LOG_FILE, request.args.get("lines", LOG_TAIL_LINES, type=int))
+            else:
+                data, offset, size = read_range(LOG_FILE, offset, request.args.get("limit", 65536, type=int))
+            return json.dumps({"data": data.decode("utf-8", "replace"), "offset": offset,
+                    "next": offset + len(data), "size": size})
+
         @app.route("/log.html")
         def log():
-            with open('/tmp/pi-monitor.log') as f:
-                data = f.read()
-            return render_template('log.html', data=data)
+            return render_template('log.html', stream_port=self.config["WEBCONFIG_STREAM_PORT"])
 
         @app.route("/")
         def status():
-            return render_template('status.html', config=self.monitor.config, states=self.monitor.states)
+            return render_template('status.html', config=self.monitor.config, states=self.monitor.states,
+                    stream_port=self.config["WEBCONFIG_STREAM_PORT"])
 
         @app.route("/config.html", methods=['GET', 'POST'])
         def config():
@@ -165,9 +247,264 @@ class WebConfig(threading.Thread):
             return render_template('config.html', form=form, config=self.monitor.config, fields=[])
 
         #app.run(host='0.0.0.0', port=80, debug=False, use_reloader=False)
-        bjoern.run(app, '0.0.0.0', 80, reuse_port=True)
+        bjoern.run(app, '0.0.0.0', WEBCONFIG_PORT, reuse_port=True)
+        LOGGER.info("exited...")
+
+
+class LogStreamHandler(logging.Handler):
+    '''
+        follow the log live: takes the place of the log file handler, so each record is written to the log file
+        and published to the /log channel of the event stream under the same lock, with its end offset as event id
+    '''
+
+    def __init__(self, event_stream):
+        logging.Handler.__init__(self)
+        self.event_stream = event_stream
+        self.file_handler = None
+        for handler in LOGGER.handlers:
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename == LOG_FILE:
+                self.file_handler = handler
+                self.setFormatter(handler.formatter)
+                self.setLevel(handler.level)
+
+    def emit(self, record):
+        try:
+            self.file_handler.emit(record)
+            offset = self.file_handler.stream.tell()
+            self.event_stream.publish("/log", "log", self.format(record), offset)
+        except Exception:
+            self.handleError(record)
+
+
+class EventStream(threading.Thread):
+    ''' 
+        Server-Sent Events endpoint which pushes the state changes to the connected clients.
+        All clients are served from a single select loop so there's no thread per client.
+    '''
+    _exit = threading.Event()
+    _max_buffer = 512 * 1024 # drop clients which can not keep up
+    _headers = ("HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/event-stream\r\n"
+                "Cache-Control: no-cache\r\n"
+                "Connection: keep-alive\r\n")
+
+    def __init__(self, monitor, port):
+        self.monitor = monitor
+        self._port = port
+        self._clients = {} # socket --> {"request": str, "channel": str, "buffer": str}
+        self._channels = {"/stream": self._state_snapshot, "/log": self._log_since}
+        self._log_handler = LogStreamHandler(self)
+        self._revision = 0
+        self._events = deque() # (channel, event, data, event id) to broadcast
+        self._wakeup_fds = os.pipe()
+        fcntl.fcntl(self._wakeup_fds[1], fcntl.F_SETFL, os.O_NONBLOCK)
+        threading.Thread.__init__(self)
+
+    def stop(self):
+        self._exit.set()
+        self._wakeup()
+        threading.Thread.join(self, 2)
+
+    def publish(self, channel, event, data, event_id=None):
+        ''' broadcast an event to all clients of the given channel (thread safe)'''
+        self._events.append((channel, event, data, event_id))
+        self._wakeup()
+
+    def run(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("0.0.0.0", self._port))
+        server.listen(16)
+        server.setblocking(0)
+        self._revision = self.monitor.states.revision
+        self.monitor.register_state_callback(self._state_changed)
+        LOGGER.info("Event stream listening on port %s" % self._port)
+        # the log is only published while we're listening, otherwise nobody would drain the events
+        self._swap_log_handler(self._log_handler.file_handler, self._log_handler)
+        try:
+            self._serve(server)
+        finally:
+            self._swap_log_handler(self._log_handler, self._log_handler.file_handler)
+            self.monitor.deregister_state_callback(self._state_changed)
+            for sock in self._clients.keys():
+                self._close(sock)
+            server.close()
         LOGGER.info("exited...")
 
- 
-    
- 
\ No newline at end of file
+    def _serve(self, server):
+        ''' the select loop which serves all clients'''
+        while not self._exit.is_set():
+            writers = [sock for sock, client in self._clients.items() if client["buffer"]]
+            try:
+                readable, writable, _ = select.select([server, self._wakeup_fds[0]] + self._clients.keys(), writers, [])
+            except select.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wakeup_fds[0] in readable:
+                os.read(self._wakeup_fds[0], 4096)
+                readable.remove(self._wakeup_fds[0])
+                self._broadcast_changes()
+            for sock in readable:
+                if sock is server:
+                    self._accept(server)
+                elif sock in self._clients:
+                    self._read(sock)
+            for sock in writable:
+                if sock in self._clients:
+                    self._write(sock)
+
+    @staticmethod
+    def _swap_log_handler(old, new):
+        ''' replace a handler of the logger at once, so no log record is missed or written twice'''
+        if old is not None and new is not None:
+            LOGGER.handlers = [new if handler is old else handler for handler in LOGGER.handlers]
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_fds[1], "x")
+        except OSError:
+            pass
+
+    def _state_changed(self, key, value=None, subkey=None, changes=None):
+        ''' state listener: the changes itself are collected from the state tree in the select loop'''
+        self._wakeup()
+
+    def _broadcast_changes(self):
+        ''' send all state changes since the last broadcast and any published events to the clients'''
+        revision = self.monitor.states.revision
+        if revision > self._revision:
+            changes = self.monitor.states.changes_since(self._revision)
+            self._revision = revision
+            if changes:
+                self._send("/stream", "changes", self._state_message(revision, changes), make_revision_id(revision))
+        while self._events:
+            self._send(*self._events.popleft())
+
+    def _state_snapshot(self, query, last_event_id):
+        ''' initial data for a new client of the state stream: full snapshot or the changes since a revision'''
+        revision = self.monitor.states.revision
+        since = parse_revision_id(query.get("since", [last_event_id])[0], revision)
+        if since:
+            return ("changes", self._state_message(revision, self.monitor.states.changes_since(since)),
+                    make_revision_id(revision))
+        # new client or one from before a restart: the revisions don't match ours
+        return "snapshot", self._state_message(revision, self.monitor.states), make_revision_id(revision)
+
+    @staticmethod
+    def _log_since(query, last_event_id):
+        ''' the log lines written since the given byte offset (where the client's log tail ended)'''
+        try:
+            since = int(query.get("since", [last_event_id])[0])
+        except (TypeError, ValueError):
+            return None
+        data, offset = read_range(LOG_FILE, since)[:2]
+        if not data:
+            return None
+        return "log", data.decode("utf-8", "replace").rstrip("\n"), offset + len(data)
+
+    @staticmethod
+    def _state_message(revision, changes):
+        # the clients need our (monotonic) clock to extrapolate the playback position
+        return {"revision": revision, "changes": changes, "now": monotonic()}
+
+    def _accept(self, server):
+        try:
+            sock, addr = server.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self._clients[sock] = {"request": "", "channel": None, "buffer": ""}
+
+    def _read(self, sock):
+        client = self._clients[sock]
+        try:
+            data = sock.recv(4096)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self._close(sock)
+        elif client["channel"] is None:
+            client["request"] += data
+            if "\r\n\r\n" in client["request"]:
+                self._handle_request(sock, client)
+            elif len(client["request"]) > 8192:
+                self._close(sock)
+
+    def _handle_request(self, sock, client):
+        ''' parse the http request of a new client and subscribe it to the requested channel'''
+        lines = client["request"].split("\r\n")
+        client["request"] = ""
+        try:
+            method, path = lines[0].split()[:2]
+        except ValueError:
+            method, path = "", ""
+        url = urlparse.urlparse(path)
+        if method != "GET" or url.path not in self._channels:
+            client["channel"] = ""
+            client["buffer"] = "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+            client["close"] = True
+            return
+        headers = dict(line.split(":", 1) for line in lines[1:] if ":" in line)
+        headers = dict((key.strip().lower(), value.strip()) for key, value in headers.items())
+        client["buffer"] = self._headers
+        origin = headers.get("origin")
+        if origin and self._allowed_origin(origin, headers.get("host", "")):
+            client["buffer"] += "Access-Control-Allow-Origin: %s\r\nVary: Origin\r\n" % origin
+        client["buffer"] += "\r\nretry: 3000\n\n"
+        # flush what's pending first, so the initial data of the new client can't be sent to it again,
+        # and hold the log while reading it: a line is either in the initial data or published afterwards
+        with self._log_handler.lock:
+            self._broadcast_changes()
+            client["channel"] = url.path
+            initial = self._channels[url.path](urlparse.parse_qs(url.query), headers.get("last-event-id"))
+        if initial:
+            client["buffer"] += self._format_event(*initial)
+
+    @staticmethod
+    def _allowed_origin(origin, host):
+        ''' only the pages of the webconfig itself may read the streams (the states and the log)'''
+        origin = urlparse.urlparse(origin)
+        hostname = host.rsplit(":", 1)[0] if not host.endswith("]") else host
+        return (origin.scheme == "http" and origin.hostname == hostname.strip("[]").lower() and
+                (origin.port or 80) == WEBCONFIG_PORT)
+
+    def _write(self, sock):
+        client = self._clients[sock]
+        try:
+            sent = sock.send(client["buffer"])
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._close(sock)
+            return
+        client["buffer"] = client["buffer"][sent:]
+        if not client["buffer"] and client.get("close"):
+            self._close(sock)
+
+    def _close(self, sock):
+        self._clients.pop(sock, None)
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def _send(self, channel, event, data, event_id=None):
+        message = self._format_event(event, data, event_id)
+        for sock, client in self._clients.items():
+            if client["channel"] == channel:
+                if len(client["buffer"]) > self._max_buffer:
+                    LOGGER.warning("Event stream client is too slow, disconnecting")
+                    self._close(sock)
+                else:
+                    client["buffer"] += message
+
+    @staticmethod
+    def _format_event(event, data, event_id=None):
+        message = ""
+        if event_id is not None:
+            message += "id: %s\n" % event_id
+        message += "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+        return message
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+    CoverArtCache
+    content addressed (sha256) store for the cover art of all players,
+    bounded in size (least recently used covers are evicted first) and optionally persisted on disk
+'''
+
+import os
+import threading
+from io import BytesIO
+from hashlib import sha256
+from resources.lib.utils import LOGGER, requests, OrderedDict, SerialWorkerPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None # no thumbnails, the original covers are served
+
+
+URL_CACHE_SIZE = 256 # number of remembered url --> cover id lookups
+FETCH_TIMEOUT = 10 # max seconds to wait for a cover art download
+FETCH_WORKERS = 2
+THUMBNAIL_SIZES = [64, 128, 300] # max width/height of the thumbnails (small displays, web cards)
+THUMBNAIL_QUALITY = 80 # jpeg quality
+
+
+def guess_mimetype(data):
+    ''' the mimetype of the image data, based on the first bytes'''
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    elif data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    elif data.startswith(b"GIF8"):
+        return "image/gif"
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def thumbnail_id(cover_id, size):
+    return "%s_%s" % (cover_id, size)
+
+
+class CoverArtCache(object):
+    ''' cover art by sha256 checksum, the same cover is only stored once'''
+
+    def __init__(self, max_size, cache_dir=None):
+        self.max_size = max_size
+        self.size = 0
+        self.cache_dir = cache_dir
+        self._covers = OrderedDict() # cover id (or thumbnail id) --> image data, in LRU order
+        self._thumbnailer = SerialWorkerPool(self._build_thumbnails, num_workers=1, name="thumbnailer")
+        self._fetcher = SerialWorkerPool(self._fetch, num_workers=FETCH_WORKERS, name="cover_fetcher")
+        self._urls = OrderedDict() # url --> cover id
+        self._fetching = {} # url --> callbacks waiting for the download
+        self._lock = threading.RLock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as exc:
+                LOGGER.warning("Unable to create the cover art cache dir %s: %s" % (cache_dir, exc))
+                self.cache_dir = None
+
+    def start(self):
+        self._thumbnailer.start()
+        self._fetcher.start()
+
+    def stop(self):
+        self._thumbnailer.stop()
+        self._fetcher.stop()
+
+    def put(self, data, checksum=None):
+        ''' store the image data, returns the cover id (the sha256 checksum)'''
+        if not data:
+            return ""
+        cover_id = checksum or sha256(data).hexdigest()
+        if self._store(cover_id, data) and Image:
+            # new cover: the thumbnails are built in the background, once
+            self._thumbnailer.submit(cover_id, cover_id, data)
+        return cover_id
+
+    def get_thumbnail(self, cover_id, size):
+        '''
+            get the smallest thumbnail which is at least the requested size,
+            the original cover if there's no such (or not yet a) thumbnail. Never resizes the image itself.
+        '''
+        for thumb_size in THUMBNAIL_SIZES:
+            if thumb_size >= size:
+                data = self.get(thumbnail_id(cover_id, thumb_size))
+                if data:
+                    return data
+                break
+        return self.get(cover_id)
+
+    def get(self, cover_id):
+        ''' get the image data of a cover, None if it is not (or no longer) in the cache'''
+        if not cover_id:
+            return None
+        with self._lock:
+            data = self._covers.get(cover_id)
+            if data is not None:
+                self._touch(cover_id)
+                return data
+        data = self._read_file(cover_id)
+        if data is not None:
+            # back in memory as most recently used
+            self._store(cover_id, data)
+        return data
+
+    def fetch_url(self, url, callback, timeout=FETCH_TIMEOUT):
+        '''
+            get the cover id for an image url without blocking: returns the cover id if we already have the image,
+            otherwise it is downloaded in the background and the callback is called with the cover id ("" on errors)
+        '''
+        if not url:
+            return ""
+        with self._lock:
+            cover_id = self._urls.get(url)
+            if cover_id and (cover_id in self._covers or self._has_file(cover_id)):
+                return cover_id
+            if url in self._fetching:
+                # already being downloaded, only wait for the result
+                self._fetching[url].append(callback)
+                return ""
+            self._fetching[url] = [callback]
+        self._fetcher.submit(url, url, timeout)
+        return ""
+
+    def _fetch(self, url, timeout):
+        ''' (background worker) download the image and pass the cover id to everyone waiting for it'''
+        cover_id = ""
+        try:
+            response = requests.get(url, timeout=timeout)
+            if response.status_code == 200 and response.content:
+                cover_id = self.put(response.content)
+            else:
+                LOGGER.debug("Unable to fetch cover art %s - status: %s" % (url, response.status_code))
+        except Exception as exc:
+            LOGGER.debug("Unable to fetch cover art %s: %s" % (url, exc))
+        with self._lock:
+            if cover_id:
+                self._urls[url] = cover_id
+                while len(self._urls) > URL_CACHE_SIZE:
+                    self._urls.popitem(last=False)
+            callbacks = self._fetching.pop(url, [])
+        for callback in callbacks:
+            callback(cover_id)
+
+    def __contains__(self, cover_id):
+        with self._lock:
+            return cover_id in self._covers or self._has_file(cover_id)
+
+    def _store(self, cover_id, data):
+        ''' store data in memory (and on disk), returns False if we already had it'''
+        with self._lock:
+            if cover_id in self._covers:
+                self._touch(cover_id)
+                return False
+            self._covers[cover_id] = data
+            self.size += len(data)
+            self._evict()
+        self._write_file(cover_id, data)
+        return True
+
+    def _build_thumbnails(self, cover_id, data):
+        ''' (background worker) scale the cover to all thumbnail sizes, as compact jpeg'''
+        try:
+            image = Image.open(BytesIO(data))
+            image.load()
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+        except Exception as exc:
+            LOGGER.debug("Unable to read cover art %s for the thumbnails: %s" % (cover_id, exc))
+            return
+        for size in reversed(THUMBNAIL_SIZES):
+            if max(image.size) <= size:
+                continue # never upscale, the original is served instead
+            # scale down from the previous (larger) thumbnail, that's a lot quicker
+            image.thumbnail((size, size), Image.ANTIALIAS)
+            output = BytesIO()
+            image.save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            self._store(thumbnail_id(cover_id, size), output.getvalue())
+
+    def _touch(self, cover_id):
+        self._covers[cover_id] = self._covers.pop(cover_id)
+
+    def _evict(self):
+        ''' drop the least recently used covers until we're within the max size (the newest cover is always kept)'''
+        while self.size > self.max_size and len(self._covers) > 1:
+            cover_id, data = self._covers.popitem(last=False)
+            self.size -= len(data)
+
+    def _cover_file(self, cover_id):
+        return os.path.join(self.cache_dir, cover_id)
+
+    def _has_file(self, cover_id):
+        return bool(self.cache_dir) and os.path.isfile(self._cover_file(cover_id))
+
+    def _write_file(self, cover_id, data):
+        if not self.cache_dir or self._has_file(cover_id):
+            return
+        try:
+            temp_file = self._cover_file(cover_id) + ".tmp"
+            with open(temp_file, "wb") as cover_file:
+                cover_file.write(data)
+            os.rename(temp_file, self._cover_file(cover_id))
+            self._prune_files()
+        except (IOError, OSError) as exc:
+            LOGGER.warning("Unable to write cover art to disk: %s" % exc)
+
+    def _read_file(self, cover_id):
+        if not self._has_file(cover_id):
+            return None
+        try:
+            with open(self._cover_file(cover_id), "rb") as cover_file:
+                data = cover_file.read()
+            # mark as recently used for the pruning
+            os.utime(self._cover_file(cover_id), None)
+            return data
+        except (IOError, OSError):
+            return None
+
+    def _prune_files(self):
+        ''' the disk cache is bounded at 4 times the memory size, the least recently used files are removed first'''
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(item[1] for item in files)
+        for mtime, size, path in sorted(files):
+            if total_size <= self.max_size * 4:
+                break
+            os.remove(path)
+            total_size -= size
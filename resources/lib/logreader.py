@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+    logreader
+    read parts of the (possibly huge) log file without loading all of it in memory
+'''
+
+import os
+
+
+BLOCK_SIZE = 4096 # bytes read at once when reading backwards
+MAX_READ_SIZE = 256 * 1024 # max bytes returned by a single read
+
+
+def read_range(filename, offset=0, limit=MAX_READ_SIZE):
+    '''
+        read (at most limit bytes of) the log from the given byte offset,
+        returns the data, the offset of the data and the current size of the file
+    '''
+    limit = min(max(limit, 0), MAX_READ_SIZE)
+    with open(filename, "rb") as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        if offset < 0:
+            # relative to the end of the file
+            offset = max(size + offset, 0)
+        elif offset > size:
+            # the log file was truncated (e.g. after a restart), start over
+            offset = 0
+        log_file.seek(offset)
+        data = log_file.read(limit)
+    return data, offset, size
+
+
+def read_tail(filename, lines=100):
+    '''
+        read the last lines of the log by reading backwards from the end in fixed blocks,
+        returns the data, the offset of the data and the current size of the file
+    '''
+    with open(filename, "rb") as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        if lines <= 0:
+            return b"", size, size
+        offset = size
+        blocks = []
+        newlines = 0
+        # one newline extra: the trailing newline doesn't start another line
+        while offset > 0 and newlines <= lines and size - offset < MAX_READ_SIZE:
+            read_size = min(BLOCK_SIZE, offset)
+            offset -= read_size
+            log_file.seek(offset)
+            block = log_file.read(read_size)
+            newlines += block.count(b"\n")
+            blocks.append(block)
+    data = b"".join(reversed(blocks))
+    # cut off everything before the first of the wanted lines
+    start = len(data)
+    for _ in range(lines + 1 if data.endswith(b"\n") else lines):
+        start = data.rfind(b"\n", 0, start)
+        if start == -1:
+            break
+    if start != -1:
+        data = data[start + 1:]
+        offset += start + 1
+    elif offset > 0:
+        # the max read size was hit before the wanted lines, don't start mid-line
+        if len(data) > MAX_READ_SIZE:
+            offset += len(data) - MAX_READ_SIZE
+            data = data[-MAX_READ_SIZE:]
+        start = data.find(b"\n")
+        if start != -1 and start + 1 < len(data):
+            data = data[start + 1:]
+            offset += start + 1
+    return data, offset, size
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+    PollScheduler
+    runs the (periodic) poll jobs of all modules from a single timer thread
+'''
+
+import heapq
+import threading
+from resources.lib.utils import LOGGER, monotonic
+
+
+MAX_BACKOFF = 300 # max wait between polls of an unreachable backend
+IDLE_GROWTH = 1.5 # interval multiplier when a poll did not change anything
+
+
+class PollJob(object):
+    ''' a registered poll job and its current interval'''
+
+    def __init__(self, name, func, min_interval, max_interval, is_active=None, max_backoff=MAX_BACKOFF):
+        self.name = name
+        self.func = func
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.is_active = is_active
+        self.max_backoff = max(max_backoff, max_interval)
+        self.interval = min_interval
+        self.errors = 0
+        self.due = 0
+        self.running = False
+        self.triggered = False
+
+    def next_interval(self, changed, failed):
+        '''
+            adapt the interval to the result of the last poll:
+            exponential backoff on errors, the max interval when idle,
+            the min interval when the data is changing and slowly growing towards the max when it isn't
+        '''
+        if failed:
+            self.errors += 1
+            self.interval = min(self.min_interval * 2 ** self.errors, self.max_backoff)
+            return self.interval
+        self.errors = 0
+        if self.is_active and not self.is_active():
+            self.interval = self.max_interval
+        elif changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(max(self.interval, self.min_interval) * IDLE_GROWTH, self.max_interval)
+        return self.interval
+
+
+class PollScheduler(threading.Thread):
+    '''
+        Modules register their poll jobs here instead of running their own sleeping loop.
+        The poll function returns True when the polled data changed and raises on errors.
+    '''
+    _exit = threading.Event()
+
+    def __init__(self):
+        self._jobs = {}
+        self._queue = [] # heap of (due time, job name)
+        self._cond = threading.Condition()
+        threading.Thread.__init__(self, name="PollScheduler")
+        self.daemon = True
+
+    def stop(self):
+        self._exit.set()
+        with self._cond:
+            self._cond.notify()
+        threading.Thread.join(self, 2)
+
+    def register(self, name, func, min_interval, max_interval, is_active=None, max_backoff=MAX_BACKOFF):
+        ''' register a poll job, the first poll is done right away'''
+        job = PollJob(name, func, min_interval, max_interval, is_active, max_backoff)
+        with self._cond:
+            self._jobs[name] = job
+            self._schedule(job, 0)
+
+    def unregister(self, name):
+        with self._cond:
+            self._jobs.pop(name, None)
+
+    def trigger(self, name):
+        ''' poll now, e.g. because the backend told us something changed'''
+        with self._cond:
+            job = self._jobs.get(name)
+            if not job:
+                return
+            job.interval = job.min_interval
+            if job.running:
+                job.triggered = True
+            else:
+                self._schedule(job, 0)
+
+    @property
+    def stats(self):
+        with self._cond:
+            return dict((job.name, {"interval": job.interval, "errors": job.errors})
+                    for job in self._jobs.values())
+
+    def _schedule(self, job, delay):
+        # monotonic: a Pi has no RTC, the wall clock may jump (backwards) when NTP syncs
+        job.due = monotonic() + delay
+        heapq.heappush(self._queue, (job.due, job.name))
+        self._cond.notify()
+
+    def _next_job(self):
+        ''' wait until the next job is due'''
+        with self._cond:
+            while not self._exit.isSet():
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, name = self._queue[0]
+                job = self._jobs.get(name)
+                if not job or job.due != due:
+                    # unregistered or rescheduled in the mean time
+                    heapq.heappop(self._queue)
+                    continue
+                wait = due - monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._queue)
+                job.running = True
+                return job
+        return None
+
+    def run(self):
+        while not self._exit.isSet():
+            job = self._next_job()
+            if not job:
+                break
+            changed = failed = False
+            try:
+                changed = job.func()
+            except Exception as exc:
+                failed = True
+                LOGGER.warning("Poll job %s failed (attempt %s): %s" % (job.name, job.errors + 1, exc))
+            with self._cond:
+                job.running = False
+                interval = job.next_interval(changed, failed)
+                if job.triggered:
+                    job.triggered = False
+                    interval = 0
+                if self._jobs.get(job.name) is job:
+                    self._schedule(job, interval)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import time
+from operator import attrgetter
 from .metadata import Infos, Item, CoverArt
+from .parser import ItemParser
 from resources.lib.utils import LOGGER
 import threading
 import os
@@ -13,179 +15,31 @@ class Processor(object):
         self._listeners = []
         self.info = Infos()
         self._exit = False
+        self._parser = ItemParser()
+
+    def process_data(self, data):
+        ''' process raw data read from the metadata pipe, it does not need to contain complete items'''
+        for item in self._parser.feed(data):
+            self.process_item(item)
 
     def process_line(self, line):
-        item = Item(line)
-        if item is None:
-            return
+        ''' process (a line with) one or more complete items'''
+        for item in ItemParser().feed(line):
+            self.process_item(item)
+
+    def process_item(self, item):
         #print("{type}, {code}".format(type = item.type, code = item.code))
-        if not hasattr(item, "type"):
-            #LOGGER.warn("Got typeless (malformed) data: >>{data}<<".format(data=line))
-            LOGGER.debug("Got typeless (malformed) data")
+        entry = CODES.get((item.type, item.code))
+        if entry is None:
+            # LOGGER.warn("Unknown {type} code \"{code}\", with base64 data {data}.".format(type=item.type, code=item.code, data=item.data_base64))
             return
-        if item.type == "ssnc":
-            if item.code == "PICT":  # the payload is a picture, either a JPEG or a PNG. Check the first few bytes to see which.
-                self.info.songcoverart = CoverArt(binary=item.data, base64=item.data_base64)  # this is not base64, but raw.
-                self.info.cover_file = self.info.write_cover_file().name
-                self._trigger_update_event(COVERART)
-            elif item.code == "mdst":  # -- a sequence of metadata is about to start
-                self._trigger_update_event(META_START)
-            elif item.code == "snua":  # -- for example: iTunes/12.2 (Macintosh; OS X 10.9.5)
-                self.info.useragent = item.data_str
-            elif item.code == "mden":  # -- a sequence of metadata has ended
-                assert(self.info is not None)
-                self._trigger_update_event(META)
-            elif item.code == "pbeg":  # -- play stream begin. Means someone connected? ("prsm" will be send on playing)  No arguments
-                self._trigger_update_event(STATE)
-                #self.info = Infos()  # reset infos
-                #print("PBEG!")  # see https://github.com/mikebrady/shairport-sync-metadata-reader/issues/5
-            elif item.code == "pfls":  # -- pause stream. No arguments(?)
-                self.info.playstate = Infos.PAUSE
-                self._trigger_update_event(STATE)
-            elif item.code == "prsm":  # -- play stream start/resume. No arguments
-                self.info.playstate = Infos.PLAYING
-                self._trigger_update_event(STATE)
-            elif item.code == "pend":  # -- play stream end. No arguments
-                self.info.playstate = Infos.STOPPED
-                self._trigger_update_event(STATE)
-            elif item.code == "pvol":  # -- play volume. The volume is sent as a string
-                # "airplay_volume,volume,lowest_volume,highest_volume",
-                # where "volume", "lowest_volume" and "highest_volume" are given in dB.
-                # The "airplay_volume" is what's sent by the source (e.g. iTunes) to the player,
-                # and is from 0.00 down to -30.00, with -144.00 meaning "mute".
-                # This is linear on the volume control slider of iTunes or iOS AirPlay.
-                airplay_volume, volume, lowest_volume, highest_volume = tuple([float(i) for i in item.data_str.split(',')])
-                self.info.volume = -1 if airplay_volume == -144 else ((volume - (lowest_volume)) / (-1* (lowest_volume - highest_volume)))
-                self.info.airplayvolume = -1 if airplay_volume == -144 else ((airplay_volume + 30) / 30)
-                self._trigger_update_event(VOLUME)
-            elif item.code == "daid":  # -- DACP-ID
-                self.info.dacp_id = item.data_str
-                self._check_remote()
-            elif item.code == "acre":  # -- Active-Remote
-                self.info.active_remote = item.data_str
-                self._check_remote()
-            # elif item.code in ["prgr"]:
-            #   LOGGER.warn("Found (already familiar) unknown shairport-sync core (ssnc) code \"{code}\", with base64 data {data}. Any Idea what that means?".format(code=item.code, data=item.data_base64))
-            # else:
-            #   LOGGER.warn("Unknown shairport-sync core (ssnc) code \"{code}\", with base64 data {data}.".format(code=item.code, data=item.data_base64))
-                #raise AttributeError("Unknown shairport-sync (ssnc) code \"{code}\", got data {data}.".format(code=item.code, data=item.data_base64))
-        elif item.type == "core":  # -- dmap.itemkind
-            if item.code == "mikd":  # -- the kind of item.  So far, only '2' has been seen, an audio
-                assert item.data_int == 2  # So far, only '2' has been seen.
-                self.info.itemkind = item.data_int
-            elif item.code == "minm":  # -- dmap.itemname
-                self.info.itemname = item.data_str
-            elif item.code == "mper":  # -- dmap.persistentid
-                self.info.persistentid = item.data_int
-            elif item.code == "miid":  # -- dmap.itemid
-                self.info.itemid = item.data_int
-
-
-            elif item.code == "asal":  # -- daap.songalbum
-                self.info.songalbum = item.data_str
-            elif item.code == "asar":  # -- daap.songartist
-                self.info.songartist = item.data_str
-            elif item.code == "ascm":  # -- daap.songcomment
-                self.info.songcomment = item.data_str
-            elif item.code == "asco":  # -- daap.songcompilation
-                self.info.songcompilation = item.data_bool
-            elif item.code == "asbr":  # -- daap.songbitrate
-                self.info.songbitrate = item.data_int
-            elif item.code == "ascp":  # -- daap.songcomposer
-                self.info.songcomposer = item.data_str
-            elif item.code == "asda":  # -- daap.songdateadded
-                self.info.songdateadded = item.data_date
-            elif item.code == "aspl":  # -- daap.songdateplayed # https://github.com/jkiddo/jolivia/blob/46e53969d4b4bfb4a538511591b9ad2a8f3fca80/jolivia.protocol/src/main/java/org/dyndns/jkiddo/dmp/IDmapProtocolDefinition.java#L154
-                self.info.songdateplayed = item.data_date  # I get dates 25 years in the future, year 2040
-            elif item.code == "asdm":  # -- daap.songdatemodified
-                self.info.songdatemodified = item.data_date
-            elif item.code == "asdc":  # -- daap.songdisccount #SongDiscCount, not the being-cheap Discount. lol.
-                self.info.songdisccount = item.data_int
-            elif item.code == "asdn":  # -- daap.songdiscnumber
-                self.info.songdiscnumber = item.data_int
-            elif item.code == "aseq":  # -- daap.songeqpreset
-                self.info.songeqpreset = item.data_str
-            elif item.code == "asgn":  # -- daap.songgenre
-                self.info.songgenre = item.data_str
-            elif item.code == "asdt":  # -- daap.songdescription
-                self.info.songdescription = item.data_str
-            elif item.code == "asrv":  # -- daap.songrelativevolume
-                self.info.songrelativevolume = item.data_int
-            elif item.code == "assr":  # -- daap.songsamplerate
-                self.info.songsamplerate = item.data_int
-            elif item.code == "assz":  # -- daap.daap.songsize
-                self.info.songsize = item.data_int
-            elif item.code == "asst":  # -- daap.songstarttime, in ms
-                self.info.songstarttime = item.data_int  # in ms
-            elif item.code == "assp":  # -- daap.songstoptime
-                self.info.songstoptime = item.data_int
-            elif item.code == "astm":  # -- daap.songtime, in ms
-                self.info.songtime = item.data_int # in ms
-            elif item.code == "astc":  # -- daap.songtrackcount
-                self.info.songtrackcount = item.data_int
-            elif item.code == "astn":  # -- daap.songtracknumber
-                self.info.songtracknumber = item.data_int
-            elif item.code == "asur":  # -- daap.songuserrating
-                self.info.songuserrating = item.data_int
-            elif item.code == "asyr":  # -- daap.songyear
-                self.info.songyear = item.data_int
-            elif item.code == "asfm":  # -- daap.songformat
-                self.info.songformat = item.data_str
-            elif item.code == "asdb":  # -- daap.songdisabled
-                self.info.songdisabled = item.data_bool
-            elif item.code == "asdk":  # -- daap.songdatakind
-                self.info.songdatakind = item.data_int
-            elif item.code == "asbt":  # -- daap.songsbeatsperminute
-                self.info.songsbeatsperminute = item.data_int
-            elif item.code == "agrp":  # -- daap.songgrouping
-                self.info.songgrouping = item.data_str
-                self._found_new_info("songgrouping")
-            elif item.code == "ascd":  # -- daap.songcodectype
-                self.info.songcodectype = item.data_str
-            elif item.code == "ascs":  # -- daap.songcodecsubtype
-                self.info.songcodecsubtype = item.data_int
-            elif item.code == "asct":  # -- daap.songcategory
-                self.info.songcategory = item.data_str
-            elif item.code == "ascn":  # -- daap.songcontentdescription
-                self.info.songcontentdescription = item.data_str
-                self._found_new_info("songgrouping")
-            elif item.code == "ascr":  # -- daap.songcontentrating
-                self.info.songcontentrating = item.data_int
-                self._found_new_info("songcontentrating")
-            elif item.code == "asri":  # -- daap.songartistid
-                self.info.songartistid = item.data_int
-            elif item.code == "asai":  # -- daap.songalbumid
-                self.info.songalbumid = item.data_int
-            elif item.code == "askd":  # -- daap.songlastskipdate
-                self.info.songlastskipdate = item.data_date
-            elif item.code == "assn":  # -- daap.sortname
-                self.info.sortname = item.data_str
-            elif item.code == "assu":  # -- daap.sortalbum
-                self.info.sortalbum = item.data_str
-
-
-            elif item.code == "aeNV":  # -- com.apple.itunes.norm-volume
-                self.info.itunesnormvolume = item.data_int
-            elif item.code == "aePC":  # -- com.apple.itunes.is-podcast
-                self.info.itunesispodcast = item.data_bool
-            elif item.code == "aeHV":  # -- com.apple.itunes.has-video
-                self.info.ituneshasvideo = item.data_bool
-            elif item.code == "aeMK":  # -- com.apple.itunes.mediakind
-                self.info.itunesmediakind = item.data_int
-            elif item.code == "aeSN":  # -- com.apple.itunes.series-name
-                self.info.itunesseriesname = item.data_str
-            elif item.code == "aeEN":  # -- com.apple.itunes.episode-num-str
-                self.info.itunesepisodenumstr = item.data_str
-
-
-            # elif item.code in ["meia", "meip"]:
-            #   LOGGER.warn("Found (already familiar) unknown DMAP-core code: {code}, with base64 data {data}. Any Idea what that means?".format(code=item.code, data=item.data_base64))
-            # else:
-            #   LOGGER.warn("Unknown DMAP-core code: {code}, with data {data}.".format(code=item.code, data=item.data_base64))
-                #raise AttributeError("Unknown DMAP (core) code \"{code}\", data is {data}".format(code=item.code, data=item.data_base64))
-            #end if-else
-        #end if shairport / if core
-        pass
+        field, decoder, event, handler = entry
+        if field:
+            setattr(self.info, field, decoder(item))
+        if handler:
+            handler(self, item)
+        if event:
+            self._trigger_update_event(event)
     #end def
 
     def _found_new_info(self, attr):
@@ -241,3 +95,116 @@ META_START = "meta start"
 COVERART = "coverart"
 CLIENT_REMOTE_AVAILABLE = "client remote available"
 STATE = "player state changed"
+PROGRESS = "progress"
+
+
+# the item data decoders
+STR = attrgetter("data_str")
+INT = attrgetter("data_int")
+BOOL = attrgetter("data_bool")
+DATE = attrgetter("data_date")
+
+CODES = {} # (type, code) --> (Infos field, data decoder, event to trigger, handler)
+
+def register_code(item_type, code, field=None, decoder=STR, event=None, handler=None):
+    """
+    Register how the items with the given type and code are processed.
+    :param field: the Infos field which is set with the data of the item, decoded with decoder(item).
+    :param event: the event which is triggered after processing the item.
+    :param handler: called as handler(processor, item) for anything more complicated.
+    """
+    CODES[(item_type, code)] = (field, decoder, event, handler)
+
+
+def _constant(value):
+    return lambda item: value
+
+def _handle_coverart(processor, item):
+    # the payload is a picture, either a JPEG or a PNG. Check the first few bytes to see which.
+    processor.info.songcoverart = CoverArt(binary=item.data, base64=item.data_base64)  # this is not base64, but raw.
+
+def _handle_volume(processor, item):
+    # The volume is sent as a string "airplay_volume,volume,lowest_volume,highest_volume",
+    # where "volume", "lowest_volume" and "highest_volume" are given in dB.
+    # The "airplay_volume" is what's sent by the source (e.g. iTunes) to the player,
+    # and is from 0.00 down to -30.00, with -144.00 meaning "mute".
+    # This is linear on the volume control slider of iTunes or iOS AirPlay.
+    airplay_volume, volume, lowest_volume, highest_volume = tuple([float(i) for i in item.data_str.split(',')])
+    processor.info.volume = -1 if airplay_volume == -144 else ((volume - (lowest_volume)) / (-1* (lowest_volume - highest_volume)))
+    processor.info.airplayvolume = -1 if airplay_volume == -144 else ((airplay_volume + 30) / 30)
+
+def _decode_progress(item):
+    # "start/current/end" as rtp timestamps (44100 per second)
+    return tuple([int(i) for i in item.data_str.split('/')])
+
+def _check_remote(processor, item):
+    processor._check_remote()
+
+def _found_new_info(processor, item):
+    processor._found_new_info(CODES[(item.type, item.code)][0])
+
+
+# shairport-sync control codes
+register_code("ssnc", "PICT", event=COVERART, handler=_handle_coverart)
+register_code("ssnc", "mdst", event=META_START)  # a sequence of metadata is about to start
+register_code("ssnc", "snua", "useragent", STR)  # for example: iTunes/12.2 (Macintosh; OS X 10.9.5)
+register_code("ssnc", "mden", event=META)  # a sequence of metadata has ended
+register_code("ssnc", "pbeg", event=STATE)  # play stream begin. Means someone connected? ("prsm" will be send on playing)  No arguments
+register_code("ssnc", "pfls", "playstate", _constant(Infos.PAUSE), STATE)  # pause stream. No arguments(?)
+register_code("ssnc", "prsm", "playstate", _constant(Infos.PLAYING), STATE)  # play stream start/resume. No arguments
+register_code("ssnc", "pend", "playstate", _constant(Infos.STOPPED), STATE)  # play stream end. No arguments
+register_code("ssnc", "pvol", event=VOLUME, handler=_handle_volume)  # play volume
+register_code("ssnc", "daid", "dacp_id", STR, handler=_check_remote)  # DACP-ID
+register_code("ssnc", "acre", "active_remote", STR, handler=_check_remote)  # Active-Remote
+register_code("ssnc", "prgr", "progress", _decode_progress, PROGRESS)  # progress, sent on play start, resume and seek
+
+# DMAP codes
+register_code("core", "mikd", "itemkind", INT)  # the kind of item.  So far, only '2' has been seen, an audio
+register_code("core", "minm", "itemname", STR)  # dmap.itemname
+register_code("core", "mper", "persistentid", INT)  # dmap.persistentid
+register_code("core", "miid", "itemid", INT)  # dmap.itemid
+register_code("core", "asal", "songalbum", STR)  # daap.songalbum
+register_code("core", "asar", "songartist", STR)  # daap.songartist
+register_code("core", "ascm", "songcomment", STR)  # daap.songcomment
+register_code("core", "asco", "songcompilation", BOOL)  # daap.songcompilation
+register_code("core", "asbr", "songbitrate", INT)  # daap.songbitrate
+register_code("core", "ascp", "songcomposer", STR)  # daap.songcomposer
+register_code("core", "asda", "songdateadded", DATE)  # daap.songdateadded
+register_code("core", "aspl", "songdateplayed", DATE)  # daap.songdateplayed # https://github.com/jkiddo/jolivia/blob/46e53969d4b4bfb4a538511591b9ad2a8f3fca80/jolivia.protocol/src/main/java/org/dyndns/jkiddo/dmp/IDmapProtocolDefinition.java#L154
+register_code("core", "asdm", "songdatemodified", DATE)  # daap.songdatemodified
+register_code("core", "asdc", "songdisccount", INT)  # daap.songdisccount #SongDiscCount, not the being-cheap Discount. lol.
+register_code("core", "asdn", "songdiscnumber", INT)  # daap.songdiscnumber
+register_code("core", "aseq", "songeqpreset", STR)  # daap.songeqpreset
+register_code("core", "asgn", "songgenre", STR)  # daap.songgenre
+register_code("core", "asdt", "songdescription", STR)  # daap.songdescription
+register_code("core", "asrv", "songrelativevolume", INT)  # daap.songrelativevolume
+register_code("core", "assr", "songsamplerate", INT)  # daap.songsamplerate
+register_code("core", "assz", "songsize", INT)  # daap.daap.songsize
+register_code("core", "asst", "songstarttime", INT)  # daap.songstarttime, in ms
+register_code("core", "assp", "songstoptime", INT)  # daap.songstoptime
+register_code("core", "astm", "songtime", INT)  # daap.songtime, in ms
+register_code("core", "astc", "songtrackcount", INT)  # daap.songtrackcount
+register_code("core", "astn", "songtracknumber", INT)  # daap.songtracknumber
+register_code("core", "asur", "songuserrating", INT)  # daap.songuserrating
+register_code("core", "asyr", "songyear", INT)  # daap.songyear
+register_code("core", "asfm", "songformat", STR)  # daap.songformat
+register_code("core", "asdb", "songdisabled", BOOL)  # daap.songdisabled
+register_code("core", "asdk", "songdatakind", INT)  # daap.songdatakind
+register_code("core", "asbt", "songsbeatsperminute", INT)  # daap.songsbeatsperminute
+register_code("core", "agrp", "songgrouping", STR, handler=_found_new_info)  # daap.songgrouping
+register_code("core", "ascd", "songcodectype", STR)  # daap.songcodectype
+register_code("core", "ascs", "songcodecsubtype", INT)  # daap.songcodecsubtype
+register_code("core", "asct", "songcategory", STR)  # daap.songcategory
+register_code("core", "ascn", "songcontentdescription", STR, handler=_found_new_info)  # daap.songcontentdescription
+register_code("core", "ascr", "songcontentrating", INT, handler=_found_new_info)  # daap.songcontentrating
+register_code("core", "asri", "songartistid", INT)  # daap.songartistid
+register_code("core", "asai", "songalbumid", INT)  # daap.songalbumid
+register_code("core", "askd", "songlastskipdate", DATE)  # daap.songlastskipdate
+register_code("core", "assn", "sortname", STR)  # daap.sortname
+register_code("core", "assu", "sortalbum", STR)  # daap.sortalbum
+register_code("core", "aeNV", "itunesnormvolume", INT)  # com.apple.itunes.norm-volume
+register_code("core", "aePC", "itunesispodcast", BOOL)  # com.apple.itunes.is-podcast
+register_code("core", "aeHV", "ituneshasvideo", BOOL)  # com.apple.itunes.has-video
+register_code("core", "aeMK", "itunesmediakind", INT)  # com.apple.itunes.mediakind
+register_code("core", "aeSN", "itunesseriesname", STR)  # com.apple.itunes.series-name
+register_code("core", "aeEN", "itunesepisodenumstr", STR)  # com.apple.itunes.episode-num-str
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'luckydonald'
 
-from resources.lib.utils import LOGGER, try_decode, try_encode, etree_to_dict
+from resources.lib.utils import LOGGER, try_decode, try_encode
 
 from hashlib import sha256
-import xml.etree.ElementTree as xml
-from DictObject import DictObject
+import binascii
+import struct
 
 try:
 	from base64 import decodestring as decodebytes
@@ -14,7 +14,6 @@ except: # python3?
 	from base64 import decodebytes, encodebytes
 
 from datetime import datetime
-import tempfile  # write cover image to temp file
 import magic
 
 
@@ -36,8 +35,8 @@ class Infos(object):
 		self.playstate = self.STOPPED				# Enum: Infos.PLAYING, Infos.STOPPED
 		self.useragent = None  				# unicode, e.g. iTunes/12.2 (Macintosh; OS X 10.9.5)
 		self.songcoverart = CoverArt()		# CoverArt, (with bytes, base64, mime and stuff)
-		self.cover_file = None
 		self.airplayvolume = None			# float, from 0-1. This is linear what the client sends. (Python2 has a `double` type, too, not sure which you get there.)
+		self.progress = None				# tuple, (start, current, end) rtp timestamps of the current song, 44100 per second
 
 		self.dacp_id = None 				# str, the DACP-ID.				Needed for controlling the streaming client. See http://git.io/vZPp1
 		self.active_remote = None		  	# str, the Active-Remote token.	Needed for controlling the streaming client. See http://git.io/vZPp1
@@ -88,12 +87,6 @@ class Infos(object):
 		self.itunesispodcast = None			# bool
 		self.ituneshasvideo = None			# bool
 
-	def write_cover_file(self):
-		temp_file = tempfile.NamedTemporaryFile(prefix="image_", suffix=".png", delete=False)
-		with temp_file as file:
-			file.write(self.songcoverart.binary)  # this is not base64!
-		return temp_file
-
 	def to_simple_string(self):
 		"""
 		String like
@@ -163,33 +156,17 @@ class CoverArt(object):
 
 
 class Item(object):
-	def __init__(self, e):
-		if isinstance(e, str):
-			try:
-				e = xml.fromstring(e)
-			except Exception:
-				LOGGER.exception("Skipping malformed line")
-				return
-		if isinstance(e, xml.Element):
-			e = etree_to_dict(e)
-		if isinstance(e, dict):
-			e = DictObject.objectify(e)
-		assert isinstance(e, DictObject)
-		assert hasattr(e.item, "type")
-		self.type = ascii_integers_to_string(e.item.type)
-		self.code = ascii_integers_to_string(e.item.code)
-		self.length = int(e.item.length)
-		if "data" in e.item:
-			assert self.length > 0  # length is zero if data is undefined.
-			self.data = encoded_to_str(e.item.data["#text"], e.item.data["@encoding"], as_bytes=True)
-			if e.item.data["@encoding"] == "base64":
-				self._data_base64 = try_decode(e.item.data["#text"])
-			else:
-				self._data_base64 = None
-		else:
-			assert self.length == 0  # length is zero if data is undefined.
-			self.data = try_encode("")
-			self._data_base64 = None
+	def __init__(self, type, code, length, data=b"", data_base64=None):
+		"""
+		A single metadata item, as cut from the pipe by the ItemParser.
+		:param data: the decoded data (bytes)
+		:param data_base64: the base64 data as received, if any
+		"""
+		self.type = type
+		self.code = code
+		self.length = length
+		self.data = data
+		self._data_base64 = data_base64
 
 	@property
 	def data_str(self):
@@ -197,11 +174,15 @@ class Item(object):
 
 	@property
 	def data_int(self):
-		if self.data:
-			try:
-				return int("0x" + ''.join([hex(ord(x))[2:] for x in self.data]), base=16) #py2
-			except:
-				return int("0x" + ''.join([hex(x)[2:] for x in self.data]), base=16) #py3
+		"""
+		The data as big-endian unsigned integer, None if there is no data.
+		"""
+		unpack = INT_UNPACKERS.get(len(self.data))
+		if unpack:
+			return unpack(self.data)[0]
+		elif self.data:  # unusual width
+			return int(binascii.hexlify(self.data), 16)
+		return None
 
 	@property
 	def data_date(self):
@@ -225,20 +206,6 @@ class Item(object):
 #end def
 
 
-def ascii_integers_to_string(string, base=16, digits_per_char=2):
-	return "".join([chr(int(string[i:i+digits_per_char], base=base)) for i in range(0, len(string), digits_per_char)])
-
-
-def data_string_decode(e, as_bytes=True):
-	return encoded_to_str(e.item.data["#text"], e.item.data["@encoding"], as_bytes=as_bytes)
-
-def encoded_to_str(data, encoding, as_bytes=True):
-	if encoding == "base64":
-		bytes = decodebytes(data.encode('ascii'))
-		if as_bytes:
-			return bytes
-		else:
-			return bytes.decode("utf-8")
-	else:
-		raise AttributeError("unknown encoding format: {f}".format(f=encoding))
+# big-endian unpackers for the common integer widths (in bytes)
+INT_UNPACKERS = dict((width, struct.Struct(fmt).unpack) for width, fmt in [(1, ">B"), (2, ">H"), (4, ">I"), (8, ">Q")])
 
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Streaming tokenizer for the shairport-sync metadata pipe.
+
+    The pipe contains items like:
+        <item><type>636f7265</type><code>6d696e6d</code><length>11</length>
+        <data encoding="base64">
+        SGVsbG8gd29ybGQ=</data></item>
+    Items are cut from a bytes buffer as data comes in (e.g. from os.read),
+    without building an xml tree. The base64 data is decoded in one pass.
+'''
+
+import binascii
+from .metadata import Item
+
+ITEM_START = b"<item>"
+ITEM_END = b"</item>"
+DATA_START = b"<data encoding=\"base64\">"
+DATA_END = b"</data>"
+
+
+class ItemParser(object):
+    ''' feed it raw pipe data, it returns the complete items'''
+
+    def __init__(self):
+        self._buffer = b""
+        self._search_pos = 0 # where to continue searching for the end tag of the current item
+
+    def feed(self, data):
+        ''' add data to the buffer and return a list of all items that are complete now'''
+        items = []
+        buf = self._buffer + data if self._buffer else data
+        pos = 0
+        while True:
+            start = buf.find(ITEM_START, pos)
+            if start == -1:
+                # nothing useful (left) in the buffer, keep a possible partial start tag
+                pos = max(pos, len(buf) - len(ITEM_START))
+                self._search_pos = 0
+                break
+            # don't search the (possibly huge) part we already searched in a previous feed again
+            end = buf.find(ITEM_END, max(start, self._search_pos - len(ITEM_END)))
+            if end == -1:
+                pos = start
+                self._search_pos = len(buf)
+                break
+            self._search_pos = 0
+            item = self.parse_item(buf, start + len(ITEM_START), end)
+            if item:
+                items.append(item)
+            pos = end + len(ITEM_END)
+        if pos:
+            self._search_pos = max(0, self._search_pos - pos)
+            buf = buf[pos:]
+        self._buffer = buf
+        return items
+
+    @staticmethod
+    def parse_item(buf, start, end):
+        ''' parse the fields of the item between start and end, None if it is malformed'''
+        try:
+            item_type = binascii.unhexlify(_field(buf, b"type", start, end))
+            code = binascii.unhexlify(_field(buf, b"code", start, end))
+            length = int(_field(buf, b"length", start, end))
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        data = b""
+        data_base64 = None
+        if length:
+            data_start = buf.find(DATA_START, start, end)
+            data_end = buf.find(DATA_END, data_start, end)
+            if data_start == -1 or data_end == -1:
+                return None
+            data_base64 = buf[data_start + len(DATA_START):data_end]
+            try:
+                data = binascii.a2b_base64(data_base64)
+            except binascii.Error:
+                return None
+        return Item(item_type, code, length, data, data_base64)
+
+
+def _field(buf, tag, start, end):
+    ''' the text of a simple <tag>text</tag> field within start and end'''
+    open_tag = b"<" + tag + b">"
+    field_start = buf.find(open_tag, start, end)
+    if field_start == -1:
+        raise ValueError("missing field %s" % tag)
+    field_start += len(open_tag)
+    field_end = buf.find(b"</" + tag + b">", field_start, end)
+    if field_end == -1:
+        raise ValueError("missing field %s" % tag)
+    return buf[field_start:field_end].strip()
+
+
+if __name__ == "__main__":
+    # benchmark the parser with a recorded capture of the metadata pipe:
+    # python -m resources.lib.shairportdecoder.parser /path/to/capture [chunk size]
+    import sys
+    import time
+    if len(sys.argv) < 2:
+        print "usage: python -m resources.lib.shairportdecoder.parser <capture file> [chunk size]"
+        sys.exit(1)
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    with open(sys.argv[1], "rb") as capture_file:
+        capture = capture_file.read()
+    chunks = [capture[i:i + chunk_size] for i in range(0, len(capture), chunk_size)]
+    runs = 10
+    start_time = time.time()
+    for _ in range(runs):
+        parser = ItemParser()
+        count = 0
+        for chunk in chunks:
+            count += len(parser.feed(chunk))
+    duration = (time.time() - start_time) / runs
+    print "%s items, %.1f KB in %.2f ms per run (%.1f MB/s)" % (
+            count, len(capture) / 1024.0, duration * 1000, len(capture) / duration / 1024 / 1024)
@@ -9,6 +9,11 @@ import inspect
 import sys
 import platform
 import os
+import threading
+import itertools
+import ctypes
+import ctypes.util
+from contextlib import contextmanager
 
 try:
     from subprocess import DEVNULL # py3k
@@ -39,6 +44,7 @@ PLAYING_STATES = [PLAYING_STATE, LISTENING_STATE, LOADING_STATE, NOTIFY_STATE, S
 INTERRUPT_STATES = [NOTIFY_STATE, ALERT_STATE, LISTENING_STATE, SPEAKING_STATE]
 VOLUME_CONTROL_SOFT = "SoftMaster"
 VOLUME_CONTROL_DISABLED = "no volume control"
+VOLUME_STEP = 2
 
 LIBS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 RESOURCES_FOLDER = os.path.abspath(os.path.join(LIBS_FOLDER, os.pardir))
@@ -191,7 +197,7 @@ def global_import(modulename, shortname = None, asfunction = False, calling_modu
 
 import_or_install("requests")
 import_or_install("simplejson", "json")
-import_or_install("collections", ["OrderedDict", "defaultdict"], True)
+import_or_install("collections", ["OrderedDict", "defaultdict", "deque"], True)
 
 
 def try_encode(text, encoding="utf-8"):
@@ -235,77 +241,309 @@ def etree_to_dict(t):
     return d
 
 
+class SerialWorkerPool(object):
+    '''
+        Fixed size pool of worker threads which executes jobs in order per key.
+        Jobs for the same key never run concurrently, jobs for different keys run in parallel.
+        If max_queue is set, new jobs are dropped when that many jobs are already pending.
+        The optional coalesce callback receives the pending jobs of a key and the new job,
+        if it returns True the new job is considered merged into the pending jobs.
+    '''
+
+    def __init__(self, handler, num_workers=3, max_queue=0, stats=None, name="worker", coalesce=None):
+        self._handler = handler
+        self._coalesce = coalesce
+        self._num_workers = max(1, int(num_workers))
+        self._max_queue = int(max_queue)
+        self._stats = stats
+        self._name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = {}  # key --> deque of pending jobs
+        self._ready = deque()  # keys which have pending jobs and are not being processed
+        self._active = set()  # keys which are being processed by a worker
+        self._workers = []
+        self._exit = False
+        self.queued = 0
+        self.running = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def start(self):
+        for i in range(self._num_workers):
+            worker = threading.Thread(target=self._worker, name="%s-%s" % (self._name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        with self._cond:
+            self._exit = True
+            self._cond.notify_all()
+
+    def submit(self, key, *args):
+        '''queue a job for the given key, returns False if the job is dropped'''
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending and self._coalesce and self._coalesce(pending, args):
+                return True
+            if self._max_queue and self.queued >= self._max_queue:
+                self.dropped += 1
+                self._update_stats()
+                LOGGER.warning("%s queue is full, dropped job for %s" % (self._name, key))
+                return False
+            if pending is None:
+                pending = self._pending[key] = deque()
+            pending.append(args)
+            self.queued += 1
+            if key not in self._active and len(pending) == 1:
+                self._ready.append(key)
+                self._cond.notify()
+            self._update_stats()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._exit:
+                    self._cond.wait()
+                if self._exit:
+                    return
+                key = self._ready.popleft()
+                args = self._pending[key].popleft()
+                self._active.add(key)
+                self.queued -= 1
+                self.running += 1
+                self._update_stats()
+            try:
+                self._handler(*args)
+            except Exception:
+                LOGGER.exception("error in %s while processing job for %s" % (self._name, key))
+            with self._cond:
+                self._active.discard(key)
+                self.running -= 1
+                self.processed += 1
+                if self._pending[key]:
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._pending[key]
+                self._update_stats()
+
+    def _update_stats(self):
+        if self._stats is not None:
+            # one update, so it's broadcasted as a single state event
+            self._stats.update({"queued": self.queued, "running": self.running, "dropped": self.dropped})
+
+
+CLOCK_MONOTONIC = 1 # from linux/time.h
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _get_clock_gettime():
+    ''' clock_gettime from librt (older glibc) or libc, None if it's not available'''
+    for lib_name in (ctypes.util.find_library("rt"), ctypes.util.find_library("c")):
+        if not lib_name:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(lib_name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        return clock_gettime
+    return None
+
+_clock_gettime = _get_clock_gettime()
+
+
+def monotonic():
+    ''' seconds from a clock that does not jump when the system time is adjusted'''
+    # CLOCK_MONOTONIC itself: os.times() is a 32 bits clock_t on the Pi, it starts negative and wraps around
+    if _clock_gettime:
+        timespec = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) == 0:
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        LOGGER.warning("clock_gettime failed with errno %s" % ctypes.get_errno())
+    return time.time()
+
+
+_revision_counter = itertools.count(1)
+_revision_lock = threading.Lock()
+
+def next_revision():
+    ''' get a new (monotonically increasing) revision number for a state change'''
+    with _revision_lock:
+        return next(_revision_counter)
+
+
+class StateDiff(OrderedDict):
+    ''' the changes of a state event: changed key --> (old value, new value)'''
+    revision = 0
+
+    @property
+    def new_values(self):
+        return dict((key, value[1]) for key, value in self.items())
+
+
 class StatesList(list):
     state_listener = None
     parent = None
+    revision = 0
+    _parent_node = None
     def __setitem__(self, key, value):
-        self.state_changed_event(key)
+        old_value = self[key]
         super(StatesList, self).__setitem__(key, value)
+        self.state_changed_event(key, old_value, value)
     def append(self, *args, **kwargs):
         super(StatesList, self).append(*args, **kwargs)
-        self.state_changed_event(*args, **kwargs)
+        self.state_changed_event(args[0], None, args[0])
     def remove(self, *args, **kwargs):
-        super(StatesList, self).append(*args, **kwargs)
-        self.state_changed_event(*args, **kwargs)
-    def state_changed_event(self, key):
+        super(StatesList, self).remove(*args, **kwargs)
+        self.state_changed_event(args[0], args[0], None)
+    def state_changed_event(self, key, old_value, new_value):
         subkey = key
         if self.parent:
             subkey = key
             key = self.parent
+        changes = StateDiff([(subkey, (old_value, new_value))])
+        changes.revision = next_revision()
+        self.revision = changes.revision
+        if self._parent_node is not None:
+            self._parent_node._child_changed(self.parent, changes.revision)
         if self.state_listener:
-            self.state_listener((key, self, subkey))
+            self.state_listener((key, self, subkey, changes))
 
 class StatesDict(dict):
     state_listener = None
     parent = None
+    revision = 0 # revision of the last change to this node or any of its children
+    created = 0 # revision at which this node was added to its parent
+    _parent_node = None
 
     def __setitem__(self, key, value):
         # optional processing here
         if isinstance(value, dict):
-            value = StatesDict(value)
+            if not isinstance(value, StatesDict):
+                value = StatesDict(value)
             value.parent = key
             value.state_listener = self.state_listener
+            value._parent_node = self
         elif isinstance(value, list):
             value = StatesList(value)
             value.parent = key
             value.state_listener = self.state_listener
-        if self.get(key) != value and key != "last_updated":
-            super(StatesDict, self).__setitem__(key, value)
-            super(StatesDict, self).__setitem__("last_updated", time.time())
-            self.state_changed_event(key)
+            value._parent_node = self
+        with self._lock:
+            if (key not in self or self.get(key) != value) and key != "last_updated":
+                old_value = self.get(key)
+                super(StatesDict, self).__setitem__(key, value)
+                if self._batch is not None:
+                    # part of a transaction, the event is broadcasted when the transaction ends
+                    if key in self._batch:
+                        old_value = self._batch[key][0]
+                    self._batch[key] = (old_value, value)
+                else:
+                    super(StatesDict, self).__setitem__("last_updated", time.time())
+                    self.state_changed_event(StateDiff([(key, (old_value, value))]))
 
     def __delitem__(self, key):
-        super(StatesDict, self).__delitem__(key)
-        self.state_changed_event(key)
+        with self._lock:
+            old_value = self[key]
+            super(StatesDict, self).__delitem__(key)
+            self.state_changed_event(StateDiff([(key, (old_value, None))]))
 
     def update(self, new_values):
-        ''' if update is used we only broadcast an event for the state key '''
-        if not "state" in new_values:
+        ''' if update is used we only broadcast one event for all changed keys '''
+        with self.transaction():
             for key, value in new_values.items():
                 self.__setitem__(key, value)
-        else:
-            key_changed = False
-            for key, value in new_values.items():
-                if not key in self or self.get(key) != value:
-                    key_changed = True
-                    super(StatesDict, self).__setitem__(key, value)
-            if key_changed:
-                super(StatesDict, self).__setitem__("last_updated", time.time())
-                self.state_changed_event("state")
+
+    @contextmanager
+    def transaction(self):
+        ''' 
+            collect all changes made within the with block and broadcast them as one event when it ends
+            other threads can not modify this dict while the transaction is in progress
+        '''
+        with self._lock:
+            is_outer = self._batch is None
+            if is_outer:
+                self._batch = StateDiff()
+            try:
+                yield self
+            finally:
+                if is_outer:
+                    changes = self._batch
+                    self._batch = None
+                    if changes:
+                        super(StatesDict, self).__setitem__("last_updated", time.time())
+                        self.state_changed_event(changes)
 
     def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        self._batch = None
+        self._revisions = {} # key --> revision of the last change
+        self._deleted = {} # deleted key --> revision of the deletion
         val = super(StatesDict, self).__init__(*args, **kwargs)
         super(StatesDict, self).__setitem__("last_updated", time.time())
         return val
 
 
-    def state_changed_event(self, key):
-        subkey = key
+    def state_changed_event(self, changes):
+        ''' broadcast event: (key, value, subkey, StateDiff with all changes)'''
+        # the subkey is the state key if that changed (for backwards compatibility), otherwise the first changed key
+        subkey = "state" if "state" in changes else next(iter(changes))
+        key = subkey
         if self.parent:
-            subkey = key
             key = self.parent
+        changes.revision = next_revision()
+        for changed_key, (old_value, new_value) in changes.items():
+            if changed_key in self:
+                self._revisions[changed_key] = changes.revision
+                self._deleted.pop(changed_key, None)
+                if isinstance(new_value, StatesDict) and not new_value.created:
+                    new_value.created = changes.revision
+                if isinstance(new_value, (StatesDict, StatesList)):
+                    # a (replaced) node is new as a whole, its revision is used for the etags
+                    new_value.revision = max(new_value.revision, changes.revision)
+            else:
+                self._revisions.pop(changed_key, None)
+                self._deleted[changed_key] = changes.revision
+        self._child_changed(None, changes.revision)
         if self.state_listener:
-            self.state_listener((key, self.get(subkey), subkey))
+            self.state_listener((key, self.get(subkey), subkey, changes))
+
+    def _child_changed(self, key, revision):
+        ''' bump the revision of this node (and all parent nodes) after a change in a child node'''
+        # no locking here: locks are only taken from parent to child, never the other way around
+        if key is not None:
+            self._revisions[key] = max(self._revisions.get(key, 0), revision)
+        if revision > self.revision:
+            self.revision = revision
+        if self._parent_node is not None:
+            self._parent_node._child_changed(self.parent, revision)
+
+    def changes_since(self, revision):
+        ''' 
+            get all values that changed after the given revision,
+            nested nodes only contain their changed keys and deleted keys are returned as None
+        '''
+        result = {}
+        for key, key_revision in self._revisions.items():
+            if key_revision <= revision:
+                continue
+            value = self.get(key)
+            if isinstance(value, StatesDict) and value.created <= revision:
+                # a child node which already existed at the given revision, only return its changes
+                value = value.changes_since(revision)
+            result[key] = value
+        for key, key_revision in self._deleted.items():
+            if key_revision > revision:
+                result[key] = None
+        if result:
+            result["last_updated"] = self.get("last_updated")
+        return result
 
     @property
     def json(self):
@@ -359,7 +597,41 @@ class PlayerMetaData(StatesDict):
         self["cover_url"] = ""
         self["covert_art"] = ""
         self["cover_file"] = ""
+        self["cover_id"] = "" # checksum of the cover art in the monitor's cover cache
         self["volume_level"] = 0
         self["repeat"] = False
         self["shuffle"] = False
+        # the position is only published on changes (seek, pause, resume, new track),
+        # consumers extrapolate it with: position + (monotonic() - position_updated_at) * rate
+        self["position"] = 0
+        self["position_updated_at"] = 0
+        self["rate"] = 0.0
+
+    def set_position(self, position, playing=None):
+        ''' publish a new playback position (in seconds), the rate follows the play state'''
+        if playing is None:
+            playing = self["state"] == PLAYING_STATE
+        self.update({
+            "position": position,
+            "position_updated_at": monotonic(),
+            "rate": 1.0 if playing else 0.0
+            })
+
+    def set_state(self, state):
+        ''' set the player state, the position is frozen or resumed along with it'''
+        if state == self.get("state"):
+            return
+        with self.transaction():
+            self.set_position(self.current_position, state == PLAYING_STATE)
+            self["state"] = state
+
+    @property
+    def current_position(self):
+        ''' the extrapolated playback position'''
+        position = self["position"]
+        if self["rate"]:
+            position += (monotonic() - self["position_updated_at"]) * self["rate"]
+            if self.get("duration"):
+                position = min(position, self["duration"])
+        return position
 
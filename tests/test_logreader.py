@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+'''
+    reading the tail of the log file
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from resources.lib import logreader
+
+LINE = b"x" * 999 + b"\n"
+
+
+class ReadTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "test.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, data):
+        with open(self.filename, "wb") as log_file:
+            log_file.write(data)
+
+    def test_lines(self):
+        self.write(LINE * 10)
+        data, offset, size = logreader.read_tail(self.filename, 5)
+        self.assertEqual(data, LINE * 5)
+        self.assertEqual(offset, size - len(data))
+
+    def test_max_read_size(self):
+        # more lines asked than fit in a single read: whole lines only
+        self.write(LINE * 1000)
+        data, offset, size = logreader.read_tail(self.filename, 500)
+        self.assertLessEqual(len(data), logreader.MAX_READ_SIZE)
+        self.assertEqual(offset % len(LINE), 0)
+        self.assertEqual(offset + len(data), size)
+
+    def test_single_huge_line(self):
+        self.write(b"y" * (logreader.MAX_READ_SIZE + 1000))
+        data, offset, size = logreader.read_tail(self.filename, 5)
+        self.assertEqual(len(data), logreader.MAX_READ_SIZE)
+        self.assertEqual(offset + len(data), size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+'''
+    the revision ids (event ids, etags, sync points) handed out by webconfig must not match after a restart,
+    also not when the restart happens within the same wall clock second (a Pi without RTC may repeat its time)
+'''
+
+import time
+import unittest
+from modules import webconfig
+
+
+class RevisionIdTest(unittest.TestCase):
+
+    def restart(self):
+        ''' reload the module as after a restart, with a frozen wall clock'''
+        real_time = time.time
+        time.time = lambda: 1500000000.0
+        try:
+            return reload(webconfig)
+        finally:
+            time.time = real_time
+
+    def test_own_revision_is_accepted(self):
+        revision_id = webconfig.make_revision_id(5)
+        self.assertEqual(webconfig.parse_revision_id(revision_id, 10), 5)
+
+    def test_stale_revision_is_rejected_after_restart(self):
+        # reload replaces the module contents, so keep what the first run handed out
+        first_run_id = self.restart().RUN_ID
+        stale_id = webconfig.make_revision_id(5)
+        second_run = self.restart()
+        self.assertNotEqual(first_run_id, second_run.RUN_ID)
+        self.assertEqual(second_run.parse_revision_id(stale_id, 10), 0)
+
+    def test_invalid_revisions_are_rejected(self):
+        for revision_id in (None, "", "5", "abc", webconfig.make_revision_id(11), webconfig.make_revision_id(0)):
+            self.assertEqual(webconfig.parse_revision_id(revision_id, 10), 0, revision_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
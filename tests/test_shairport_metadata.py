@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+'''
+    decoding of the DMAP integers in the shairport-sync metadata items
+'''
+
+import struct
+import unittest
+from resources.lib.shairportdecoder.metadata import Item
+
+KNOWN_VALUES = [
+    (b"\x01", 1),  # e.g. a 1 byte boolean
+    (b"\x02", 2),  # mikd: item kind audio
+    (b"\x01\x00", 256),  # zero padded bytes
+    (b"\x00\x01", 1),
+    (b"\x01\x02\x03", 66051),  # unusual width
+    (b"\x00\x00\x00\x00", 0),
+    (b"\x00\x00\x01\x00", 256),
+    (b"\xff\xff\xff\xff", 4294967295),
+    (b"\x00\x00\x00\x00\x00\x00\x01\x00", 256),
+    (b"\x12\x34\x56\x78\x9a\xbc\xde\xf0", 0x123456789abcdef0),  # mper: persistent id
+]
+
+
+def make_item(data):
+    return Item(b"core", b"test", len(data), data)
+
+
+class DataIntTest(unittest.TestCase):
+
+    def test_known_values(self):
+        for data, expected in KNOWN_VALUES:
+            self.assertEqual(make_item(data).data_int, expected, repr(data))
+
+    def test_empty(self):
+        self.assertIsNone(make_item(b"").data_int)
+
+    def test_round_trip(self):
+        for fmt in (">B", ">H", ">I", ">Q"):
+            for value in (0, 1, 127, 128, 255):
+                self.assertEqual(make_item(struct.pack(fmt, value)).data_int, value)
+            max_value = 2 ** (struct.calcsize(fmt) * 8) - 1
+            self.assertEqual(make_item(struct.pack(fmt, max_value)).data_int, max_value)
+
+    def test_bool(self):
+        self.assertTrue(make_item(b"\x01").data_bool)
+        self.assertFalse(make_item(b"\x00").data_bool)
+        self.assertRaises(TypeError, lambda: make_item(b"\x02").data_bool)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+'''
+    the shairport-sync metadata pipe parser and the item dispatch table,
+    checked against a capture of the pipe (tests/data/shairport_metadata.pipe)
+'''
+
+import os
+import unittest
+from resources.lib.shairportdecoder.parser import ItemParser
+from resources.lib.shairportdecoder import decoder
+from resources.lib.shairportdecoder.metadata import Infos
+
+CAPTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shairport_metadata.pipe")
+EXPECTED_ITEMS = [
+    ("ssnc", "mdst"), ("core", "mikd"), ("core", "minm"), ("core", "asar"), ("core", "asal"),
+    ("core", "mper"), ("core", "astm"), ("core", "asdn"), ("core", "xxxx"), ("ssnc", "mden"),
+    ("ssnc", "pbeg"), ("ssnc", "prsm"), ("ssnc", "pvol"), ("ssnc", "prgr"), ("ssnc", "PICT"),
+    ("ssnc", "pfls"), ("ssnc", "pend")
+]
+
+
+def read_capture():
+    with open(CAPTURE_FILE, "rb") as capture_file:
+        return capture_file.read()
+
+
+class ItemParserTest(unittest.TestCase):
+
+    def parse(self, chunk_size):
+        capture = read_capture()
+        parser = ItemParser()
+        items = []
+        for i in range(0, len(capture), chunk_size):
+            items += parser.feed(capture[i:i + chunk_size])
+        return items
+
+    def test_capture(self):
+        items = self.parse(65536)
+        self.assertEqual([(item.type, item.code) for item in items], EXPECTED_ITEMS)
+        for item in items:
+            self.assertEqual(len(item.data), item.length)
+
+    def test_chunked(self):
+        # the pipe is read in arbitrary pieces, the items may be cut anywhere
+        expected = [(item.type, item.code, item.data) for item in self.parse(65536)]
+        for chunk_size in (1, 7, 64, 333):
+            items = [(item.type, item.code, item.data) for item in self.parse(chunk_size)]
+            self.assertEqual(items, expected, "chunk size %s" % chunk_size)
+
+    def test_malformed_item(self):
+        parser = ItemParser()
+        items = parser.feed(b"<item><type>zz</type><code>6d696b64</code><length>0</length></item>" +
+                b"<item><type>73736e63</type><code>70656e64</code><length>0</length></item>")
+        self.assertEqual([(item.type, item.code) for item in items], [("ssnc", "pend")])
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.processor = decoder.Processor()
+        self.processor.add_listener(lambda event, info: self.events.append((event, info.playstate)))
+        self.processor.process_data(read_capture())
+        self.info = self.processor.info
+
+    def test_metadata(self):
+        self.assertEqual(self.info.itemkind, 2)
+        self.assertEqual(self.info.itemname, u"Café del Mar")
+        self.assertEqual(self.info.songartist, u"Test Artist")
+        self.assertEqual(self.info.songalbum, u"Test Album")
+        self.assertEqual(self.info.persistentid, 0x123456789abcdef0)
+        self.assertEqual(self.info.songtime, 215000)
+        self.assertEqual(self.info.songdiscnumber, 1)
+
+    def test_playback(self):
+        self.assertEqual(self.info.playstate, Infos.STOPPED)
+        self.assertEqual(self.info.progress, (1000, 45100, 9482500))
+        self.assertAlmostEqual(self.info.volume, (-22.5 + 96.3) / 96.3)
+        self.assertAlmostEqual(self.info.airplayvolume, 0.5)
+        self.assertTrue(self.info.songcoverart.binary.startswith(b"\x89PNG"))
+
+    def test_events(self):
+        self.assertEqual(self.events, [
+            (decoder.META_START, Infos.STOPPED),
+            (decoder.META, Infos.STOPPED),
+            (decoder.STATE, Infos.STOPPED),
+            (decoder.STATE, Infos.PLAYING),
+            (decoder.VOLUME, Infos.PLAYING),
+            (decoder.PROGRESS, Infos.PLAYING),
+            (decoder.COVERART, Infos.PLAYING),
+            (decoder.STATE, Infos.PAUSE),
+            (decoder.STATE, Infos.STOPPED),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()